@@ -214,7 +214,7 @@ residual_form = pdeRes(input_function,state_function,
 def assembleStrainEnergy(w):
     elastic_model = ElasticModel(mesh, w, material_model.CLT)
     elastic_energy = elastic_model.elasticEnergy(E, h, dx_inplane, dx_shear)
-    return assemble_scalar(form(elastic_energy))
+    return assembleScalar(elastic_energy)
 
 # Add output to the PDE problem:
 output_name_1 = 'compliance'
@@ -121,7 +121,8 @@ fea.add_input(input_name, input_function)
 fea.add_state(name=state_name,
                 function=state_function,
                 residual_form=residual_form,
-                arguments=[input_name])
+                arguments=[input_name],
+                symmetric=True)
 fea.add_output(name=output_name_1,
                 type='scalar',
                 form=output_form_1,
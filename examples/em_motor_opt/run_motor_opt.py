@@ -96,6 +96,12 @@ fea_mm = FEA(mesh)
 fea_mm.PDE_SOLVER = 'SNES'
 fea_mm.REPORT = True
 fea_mm.record = False
+# Predict the mesh motion from the last solution, so that fewer load steps
+# are needed to reach the new edge displacements
+fea_mm.warm_start = 'tangent'
+# The Jacobian of the hyperelastic mesh motion changes slowly over the
+# load steps; refactor it every 4 iterations or when SNES stagnates
+fea_mm.lag_jacobian = 4
 
 
 # inputs for mesh motion subproblem
@@ -141,7 +147,9 @@ def solveIncremental(res,func,bc,report=False):
     relative_edge_deltas[edge_indices] -= func.vector[edge_indices.astype(np.int32)]
     STEPS, increment_deltas = getDisplacementSteps(func,
                                                 relative_edge_deltas)
-    snes_solver = SNESSolver(res, func, bc, report=report)
+    # the SNES solver of the state is created once and reused for every
+    # optimization iteration and load step
+    snes_solver = fea_mm.getNonlinearSolver(res, func, bc)
     func_old.vector[:] = func.vector
     # Incrementally set the BCs to increase to `edge_deltas`
     if report == True:
@@ -214,6 +222,8 @@ fea_em = FEA(mesh)
 fea_em.PDE_SOLVER = 'SNES'
 fea_em.REPORT = True
 fea_em.record = True
+fea_em.warm_start = 'tangent'
+fea_em.lag_jacobian = 4
 
 # Add input to the PDE problem: the inputs as the previous states
 
@@ -228,6 +238,11 @@ v_em = TestFunction(state_function_space_em)
 
 ########################### Incremental solve ###########################
 ############### much slower, but more accurate ##########################
+# The fraction of the current source that is removed from the residual;
+# the incremental residual and its SNES solver are created once at the
+# first solve and reused for every load step afterwards
+JS_fraction = Constant(mesh, 0.0)
+incremental_solver_em = dict()
 def solveIncrementalEM(res,func,bc,report=False):
     STEPS = 5
     # Incrementally set the BCs to increase to `edge_deltas`
@@ -235,16 +250,36 @@ def solveIncrementalEM(res,func,bc,report=False):
         print(80*"=")
         print(' FEA: total steps for electromagnetic solve:', STEPS)
         print(80*"=")
-    JS_scaler = 1./STEPS
-    res += pde.JS(v_em,state_function_mm,iq,p,s,Hc,angle)
+    if 'snes' not in incremental_solver_em:
+        res_incremental = res + (1.0-JS_fraction)*pde.JS(
+                                    v_em,state_function_mm,iq,p,s,Hc,angle)
+        # with the linear solver options of the state, as for its own solver
+        state = fea_em.findState(res, func)
+        incremental_solver_em['snes'] = SNESSolver(res_incremental, func, bc,
+                                    report=report,
+                                    ksp_options=fea_em.getSolverOptions(state),
+                                    options_prefix=state['options_prefix'],
+                                    fields=state['fields'],
+                                    lag_jacobian=fea_em.lag_jacobian,
+                                    lag_stagnation=fea_em.lag_stagnation)
+    snes_solver = incremental_solver_em['snes']
+    if fea_em.warm_start is not None and 'solved' in incremental_solver_em:
+        # Try the full load from the predicted state first, and fall back
+        # to the load steps from it if SNES does not converge
+        func_predicted = np.copy(getFuncArray(func))
+        JS_fraction.value = 1.0
+        snes_solver.solve(None, func.vector)
+        if snes_solver.getConvergedReason() > 0:
+            return
+        setFuncArray(func, func_predicted)
+    incremental_solver_em['solved'] = True
     for i in range(STEPS):
         if report == True:
             print(80*"=")
             print("  FEA: Step "+str(i+1)+"/"+str(STEPS)+" of electromagnetic solve")
             print(80*"=")
-        res -= JS_scaler*pde.JS(v_em,state_function_mm,iq,p,s,Hc,angle)
+        JS_fraction.value = (i+1)/STEPS
         # print(np.linalg.norm(getFuncArray(func)))
-        snes_solver = SNESSolver(res, func, bc, report=report)
         snes_solver.solve(None, func.vector)
 
 fea_em.custom_solve = solveIncrementalEM
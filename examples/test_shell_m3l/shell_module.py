@@ -146,6 +146,8 @@ class RMShell(m3l.ExplicitOperation):
         self.parameters.declare('mesh', default=None)
         self.parameters.declare('pde', default=None)
         self.parameters.declare('shells', default={})
+        # e.g. `pde.fieldSplitSolverOptions()` for the large shell meshes
+        self.parameters.declare('solver_options', default=None)
 
     def assign_attributes(self):
         self.component = self.parameters['component']
@@ -168,7 +170,8 @@ class RMShell(m3l.ExplicitOperation):
         csdl_model = LinearShellCSDL(
             module=self,
             pde=pde,
-            shells=shells)
+            shells=shells,
+            solver_options=self.parameters['solver_options'])
 
         return csdl_model
 
@@ -476,13 +479,17 @@ class LinearShellCSDL(ModuleCSDL):
     def initialize(self):
         self.parameters.declare('pde', default=None)
         self.parameters.declare('shells', default={}) # material properties
+        self.parameters.declare('solver_options', default=None)
 
 
     def define(self):
         pde = self.parameters['pde']
         shells = self.parameters['shells']
+        solver_options = self.parameters['solver_options']
         # solve the shell group:
-        self.add_module(ShellModule(pde=pde,shells=shells), name='rm_shell')
+        self.add_module(ShellModule(pde=pde,shells=shells,
+                                    solver_options=solver_options),
+                        name='rm_shell')
 
 
 class LinearShellResidualCSDL(ModuleCSDL):
@@ -1,4 +1,5 @@
 from femo.fea.fea_dolfinx import FEA
+from femo.fea.utils_dolfinx import fieldSplitOptions
 from femo.csdl_opt.fea_model import FEAModel
 from femo.csdl_opt.state_model import StateModel
 from femo.csdl_opt.output_model import OutputModel, OutputFieldModel
@@ -15,6 +16,9 @@ class ShellModule(ModuleCSDL):
     def initialize(self):
         self.parameters.declare('pde', default=None)
         self.parameters.declare('shells', default={}) # material properties
+        # linear solver options of the shell state, e.g.
+        # `pde.fieldSplitSolverOptions()`; MUMPS LU by default
+        self.parameters.declare('solver_options', default=None)
 
     def define(self):
         pde = self.parameters['pde']
@@ -82,7 +86,9 @@ class ShellModule(ModuleCSDL):
         fea.add_state(name=state_name,
                         function=state_function,
                         residual_form=residual_form,
-                        arguments=[input_name_1, input_name_2])
+                        arguments=[input_name_1, input_name_2],
+                        solver_options=self.parameters['solver_options'],
+                        symmetric=True)
         fea.add_output(name=output_name_1,
                         type='scalar',
                         form=output_form_1,
@@ -234,6 +240,18 @@ class ShellPDE(object):
                 form(TestFunction(self.VF.sub(0).collapse()[0])*dx)).getArray()
         # self.bf_sup_sizes = np.ones_like(self.bf_sup_sizes)
 
+    def fieldSplitSolverOptions(self, split_type='schur', pc_type='gamg',
+                                rtol=1e-10):
+        """
+        Solver options of the shell state with the field-split
+        preconditioner over the displacement and the rotation blocks of W,
+        with AMG on each block ('gamg' or 'hypre')
+        """
+        options = fieldSplitOptions(['u', 'theta'], split_type=split_type,
+                                    pc_type=pc_type, rtol=rtol)
+        options['fields'] = dict(u=self.W.sub(0), theta=self.W.sub(1))
+        return options
+
     def compute_alpha(self):
         h_mesh = ufl.CellDiameter(self.mesh)
         V1 = FunctionSpace(self.mesh, ('CG', 1))
@@ -1,5 +1,5 @@
 from femo.fea.fea_dolfinx import *
-from csdl import Model, CustomExplicitOperation
+from csdl import Model, CustomExplicitOperation, CustomImplicitOperation
 import csdl
 import numpy as np
 
@@ -64,14 +64,34 @@ class OutputOperation(CustomExplicitOperation):
             self.output_dim = 0
         self.add_output(output_name,
                         shape=(self.output_size,))
-        self.declare_derivatives('*', '*')
+        if self.output_dim == 1:
+            # The sparsity patterns of the partials of the field outputs
+            # are fixed, since their matrices are reassembled in place
+            for arg_name in args_dict:
+                ai, aj, _ = self.assemblePartial(arg_name).getValuesCSR()
+                rows = np.repeat(np.arange(len(ai)-1), np.diff(ai))
+                self.declare_derivatives(output_name, arg_name,
+                                            rows=rows, cols=np.array(aj))
+        else:
+            self.declare_derivatives('*', '*')
+
+    def assemblePartial(self, arg_name):
+        return self.fea.assembleCached(
+                                (self.output_name, 'partial', arg_name,
+                                    self.output_dim+1),
+                                self.output['partials'][arg_name],
+                                self.output['compiled_partials'][arg_name],
+                                dim=self.output_dim+1)
 
     def compute(self, inputs, outputs):
         for arg_name in inputs:
             arg = self.args_dict[arg_name]
             update(arg['function'], inputs[arg_name])
 
-        outputs[self.output_name] = np.array(assemble(self.output['form'],
+        outputs[self.output_name] = np.array(self.fea.assembleCached(
+                                        (self.output_name, 'output'),
+                                        self.output['form'],
+                                        self.output['compiled_form'],
                                         dim=self.output_dim))
 
     def compute_derivatives(self, inputs, derivatives):
@@ -80,11 +100,11 @@ class OutputOperation(CustomExplicitOperation):
             update(arg['function'], inputs[arg_name])
 
         for arg_name in self.args_dict:
-            derivatives[self.output_name,arg_name] = assemble(
-                                    computePartials(
-                                        self.output['form'],
-                                        self.args_dict[arg_name]['function']),
-                                    dim=self.output_dim+1)
+            partial = self.assemblePartial(arg_name)
+            if self.output_dim == 1:
+                # The values in the CSR order of the declared sparsity
+                partial = np.copy(partial.getValuesCSR()[2])
+            derivatives[self.output_name,arg_name] = partial
 
 
 
@@ -112,10 +132,16 @@ class OutputFieldModel(Model):
                                         val=1.0)
             args_list.append(arg)
 
-        e = OutputFieldOperation(fea=self.fea,
-                            args_dict=args_dict,
-                            output_name=output_name,
-                            )
+        # M^{-1} dL/darg is dense for the consistent mass matrix M, so the
+        # projection M y = L is solved as an implicit operation instead
+        if self.fea.outputs_field_dict[output_name]['lump_mass']:
+            operation = OutputFieldOperation
+        else:
+            operation = OutputFieldImplicitOperation
+        e = operation(fea=self.fea,
+                        args_dict=args_dict,
+                        output_name=output_name,
+                        )
         output = csdl.custom(*args_list, op=e)
         self.register_output(output_name, output)
 
@@ -144,16 +170,125 @@ class OutputFieldOperation(CustomExplicitOperation):
 
         self.add_output(output_name,
                         shape=(self.output_size,))
-        # self.declare_derivatives('*', '*')
+        for arg_name in args_dict:
+            # M^{-1} dL/darg has the sparsity of dL/darg for the lumped
+            # mass matrix
+            ai, aj, _ = self.fea.assembleFieldOutputPartial(
+                                        output_name, arg_name).getValuesCSR()
+            rows = np.repeat(np.arange(len(ai)-1), np.diff(ai))
+            self.declare_derivatives(output_name, arg_name,
+                                        rows=rows, cols=np.array(aj))
 
     def compute(self, inputs, outputs):
         for arg_name in inputs:
             arg = self.args_dict[arg_name]
             update(arg['function'], inputs[arg_name])
 
-        self.fea.projectFieldOutput(self.output['form'],self.output['func'])
+        self.fea.projectFieldOutput(self.output_name)
+        if self.output['record']:
+            self.output['recorder'].write_function(self.output['func'],
+                                                    self.fea.opt_iter)
+
+        outputs[self.output_name] = getFuncArray(self.output['func'])
+
+    def compute_derivatives(self, inputs, derivatives):
+        for arg_name in inputs:
+            arg = self.args_dict[arg_name]
+            update(arg['function'], inputs[arg_name])
+
+        for arg_name in self.args_dict:
+            derivatives[self.output_name, arg_name] = \
+                    self.fea.computeFieldOutputPartial(self.output_name,
+                                                        arg_name)
+
+
+class OutputFieldImplicitOperation(CustomImplicitOperation):
+    """
+    input: input/state variables
+    output: field output projected with the consistent mass matrix, as the
+            solution y of the residual M y - L = 0
+    """
+    def initialize(self):
+        self.parameters.declare('fea')
+        self.parameters.declare('args_dict')
+        self.parameters.declare('output_name')
+
+    def define(self):
+        self.fea = self.parameters['fea']
+        self.output_name = output_name = self.parameters['output_name']
+        self.args_dict = args_dict = self.parameters['args_dict']
+        for arg_name in args_dict:
+            arg = args_dict[arg_name]
+            self.add_input(arg_name,
+                            shape=(arg['shape'],),)
+        self.output = self.fea.outputs_field_dict[output_name]
+        self.add_output(output_name,
+                        shape=(self.output['shape'],))
+        self.declare_derivatives('*', '*')
+
+    def evaluate_residuals(self, inputs, outputs, residuals):
+        for arg_name in inputs:
+            arg = self.args_dict[arg_name]
+            update(arg['function'], inputs[arg_name])
+        residuals[self.output_name] = self.fea.fieldOutputResidual(
+                                        self.output_name,
+                                        outputs[self.output_name])
+
+    def solve_residual_equations(self, inputs, outputs):
+        for arg_name in inputs:
+            arg = self.args_dict[arg_name]
+            update(arg['function'], inputs[arg_name])
+
+        self.fea.projectFieldOutput(self.output_name)
         if self.output['record']:
             self.output['recorder'].write_function(self.output['func'],
                                                     self.fea.opt_iter)
 
         outputs[self.output_name] = getFuncArray(self.output['func'])
+
+    def compute_derivatives(self, inputs, outputs, derivatives):
+        # The partials M and dL/darg are applied in
+        # `compute_jacvec_product`, and reassembled there only if changed
+        for arg_name in inputs:
+            arg = self.args_dict[arg_name]
+            update(arg['function'], inputs[arg_name])
+
+    def compute_jacvec_product(self, inputs, outputs,
+                                d_inputs, d_outputs, d_residuals, mode):
+        for arg_name in inputs:
+            arg = self.args_dict[arg_name]
+            update(arg['function'], inputs[arg_name])
+
+        output_name = self.output_name
+        if output_name not in d_residuals:
+            return
+        if mode == 'fwd':
+            if output_name in d_outputs:
+                d_residuals[output_name] += self.fea.jacvecFieldOutput(
+                                    output_name, output_name,
+                                    d_outputs[output_name], mode)
+            for arg_name in self.args_dict:
+                if arg_name in d_inputs:
+                    d_residuals[output_name] += self.fea.jacvecFieldOutput(
+                                    output_name, arg_name,
+                                    d_inputs[arg_name], mode)
+        if mode == 'rev':
+            if output_name in d_outputs:
+                d_outputs[output_name] += self.fea.jacvecFieldOutput(
+                                    output_name, output_name,
+                                    d_residuals[output_name], mode)
+            for arg_name in self.args_dict:
+                if arg_name in d_inputs:
+                    d_inputs[arg_name] += self.fea.jacvecFieldOutput(
+                                    output_name, arg_name,
+                                    d_residuals[output_name], mode)
+
+    def apply_inverse_jacobian(self, d_outputs, d_residuals, mode):
+        output_name = self.output_name
+        # The mass matrix is symmetric
+        if mode == 'fwd':
+            d_outputs[output_name] = self.fea.solveFieldOutput(output_name,
+                                                d_residuals[output_name])
+        else:
+            d_residuals[output_name] = self.fea.solveFieldOutput(output_name,
+                                                d_outputs[output_name])
@@ -0,0 +1,96 @@
+
+from femo.fea.fea_dolfinx import *
+from csdl import Model, CustomExplicitOperation
+import csdl
+import numpy as np
+
+
+class ReducedModel(Model):
+    """
+    The reduced-space model of the FEA: the states are solved inside the
+    operation, and only the scalar outputs with their adjoint totals wrt
+    the inputs are exposed to CSDL
+    """
+    def initialize(self):
+        self.parameters.declare('fea', types=FEA)
+        self.parameters.declare('output_names', types=list)
+        self.parameters.declare('arg_name_list', types=list)
+
+    def define(self):
+        self.fea = self.parameters['fea']
+        arg_name_list = self.parameters['arg_name_list']
+        output_names = self.parameters['output_names']
+
+        args_dict = dict()
+        args_list = []
+        for arg_name in arg_name_list:
+            args_dict[arg_name] = self.fea.inputs_dict[arg_name]
+            arg = self.declare_variable(arg_name,
+                                shape=(args_dict[arg_name]['shape'],),
+                                val=getFuncArray(args_dict[arg_name]['function']))
+            args_list.append(arg)
+
+        e = ReducedOperation(fea=self.fea,
+                            args_dict=args_dict,
+                            output_names=output_names)
+        outputs = csdl.custom(*args_list, op=e)
+        if len(output_names) == 1:
+            outputs = (outputs,)
+        for output_name, output in zip(output_names, outputs):
+            self.register_output(output_name, output)
+
+
+class ReducedOperation(CustomExplicitOperation):
+    """
+    input: input variables
+    output: scalar outputs
+    """
+    def initialize(self):
+        self.parameters.declare('fea')
+        self.parameters.declare('args_dict')
+        self.parameters.declare('output_names')
+
+    def define(self):
+        self.fea = self.parameters['fea']
+        self.args_dict = args_dict = self.parameters['args_dict']
+        self.output_names = output_names = self.parameters['output_names']
+        for arg_name in args_dict:
+            arg = args_dict[arg_name]
+            self.add_input(arg_name,
+                            shape=(arg['shape'],),)
+        for output_name in output_names:
+            if self.fea.outputs_dict[output_name]['shape'] != 1:
+                raise ValueError("Only the scalar outputs are supported: "
+                                    +output_name)
+            self.add_output(output_name, shape=(1,))
+        self.declare_derivatives('*', '*')
+
+    def compute(self, inputs, outputs):
+        for arg_name in inputs:
+            update(self.args_dict[arg_name]['function'], inputs[arg_name])
+        self.fea.opt_iter += 1
+        self.fea.solveStates()
+        for output_name in self.output_names:
+            output = self.fea.outputs_dict[output_name]
+            outputs[output_name] = np.array(self.fea.assembleCached(
+                                        (output_name, 'output'),
+                                        output['form'],
+                                        output['compiled_form'],
+                                        dim=0))
+
+    def compute_derivatives(self, inputs, derivatives):
+        # The states are kept at the solution of the last `compute`, so
+        # they are only resolved if the inputs have changed since then
+        changed = False
+        for arg_name in inputs:
+            changed = (update(self.args_dict[arg_name]['function'],
+                                inputs[arg_name]) or changed)
+        if changed:
+            self.fea.solveStates()
+
+        totals = self.fea.compute_total_derivatives(self.output_names,
+                                                    list(self.args_dict))
+        for output_name in self.output_names:
+            for arg_name in self.args_dict:
+                derivatives[output_name, arg_name] = \
+                                        totals[output_name][arg_name]
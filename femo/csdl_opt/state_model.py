@@ -3,6 +3,8 @@ from femo.fea.fea_dolfinx import *
 from csdl import Model, CustomImplicitOperation
 import csdl
 import numpy as np
+import scipy.linalg
+from collections import deque
 
 class StateModel(Model):
 
@@ -69,8 +71,26 @@ class StateOperation(CustomImplicitOperation):
                         shape=(self.state['shape'],),)
         self.declare_derivatives('*', '*')
         self.bcs = self.fea.bc
-        self.linear = self.fea.linear_problem
+        self.linear = self.state['linear']
+        # The user-given partials are only available as matrices
+        self.matrix_free = (self.fea.matrix_free
+                            and self.state['dR_df_list'] is None)
+        if self.matrix_free:
+            self.actions = self.fea.getStateActions(state_name)
         self.ksp = None
+        self.A_T = None
+        self.ksp_T = None
+        self.solution_point = None
+        self.dRdf_dict = dict()
+        # The last converged (inputs, state) pairs for the warm start
+        self.history = deque(maxlen=max(self.fea.warm_start_history, 1))
+        self.linearization_point = None
+        self.adjoint_rtol = None
+        self.block_solution = None
+        self.block_pending = False
+        self.solution_cache = None
+        if self.fea.solution_cache_size > 0:
+            self.solution_cache = SolutionCache(self.fea.solution_cache_size)
 
     def evaluate_residuals(self, inputs, outputs, residuals):
         if self.debug_mode == True:
@@ -82,7 +102,11 @@ class StateOperation(CustomImplicitOperation):
             arg = self.args_dict[arg_name]
             update(arg['function'], inputs[arg_name])
         update(self.state['function'], outputs[self.state_name])
-        residuals[self.state_name] = assembleVector(self.state['residual_form'])
+        residuals[self.state_name] = self.fea.assembleCached(
+                                        (self.state_name, 'residual'),
+                                        self.state['residual_form'],
+                                        self.state['compiled_residual'],
+                                        dim=1)
 
     def solve_residual_equations(self, inputs, outputs):
         if self.debug_mode == True:
@@ -100,11 +124,40 @@ class StateOperation(CustomImplicitOperation):
                 
         update(self.state['function'], outputs[self.state_name])
 
-        self.fea.solve(self.state['residual_form'],
-                        self.state['function'],
-                        self.bcs)
+        cache = self.solution_cache
+        entry = None
+        initialize = None
+        if cache is not None:
+            key = cache.key(inputs)
+            entry = cache.get(key)
+        if entry is None:
+            prediction = self.predictState(inputs)
+            if prediction is not None:
+                update(self.state['function'], prediction)
+                initialize = False
+            elif cache is not None:
+                # Warm start from the cached state of the closest inputs
+                closest_entry = cache.closest(inputs)
+                if closest_entry is not None:
+                    update(self.state['function'], closest_entry['state'])
+                    initialize = False
+
+        if entry is not None:
+            # Exact repeat of a cached design point; the persistent solver
+            # is not at this solution anymore
+            update(self.state['function'], entry['state'])
+            self.state['solver_at_solution'] = False
+        else:
+            self.fea.solve(self.state['residual_form'],
+                            self.state['function'],
+                            self.bcs,
+                            initialize=initialize)
 
         outputs[self.state_name] = getFuncArray(self.state['function'])
+        self.solution_point = self.copyPoint(inputs, outputs)
+        if cache is not None and entry is None:
+            cache.put(key, inputs, outputs[self.state_name])
+        self.addToHistory(inputs, outputs)
         if self.fea.record:
             if self.state['function'].function_space.num_sub_spaces > 1:
                 u_mid,_ = self.state['function'].split()
@@ -124,39 +177,192 @@ class StateOperation(CustomImplicitOperation):
             update(self.args_dict[arg_name]['function'], inputs[arg_name])
         update(self.state['function'], outputs[self.state_name])
 
+        # The partials are only reassembled if the functions that they
+        # depend on have changed since the last assembly
         state = self.state
+        state_name = self.state_name
         args_dict = self.args_dict
-        dR_du = state['dR_du']
-        if dR_du == None:
-            dR_du = computePartials(state['residual_form'],state['function'])
-        self.dRdu = assembleMatrix(dR_du)
-        dRdf_dict = dict()
+        dRdf_dict = self.dRdf_dict
         dR_df_list = state['dR_df_list']
         arg_list = state['arguments']
+        if self.matrix_free:
+            # The products are computed with the actions of the partials
+            arg_list = []
+        else:
+            self.dRdu = self.fea.assembleCached((state_name, 'dR_du'),
+                                                state['dR_du'],
+                                                state['compiled_dR_du'],
+                                                dim=2)
         for arg_ind in range(len(arg_list)):
             arg_name = arg_list[arg_ind]
             if dR_df_list == None:
-                dRdf = assembleMatrix(computePartials(
-                                    state['residual_form'],
-                                    args_dict[arg_name]['function']))
+                dRdf = self.fea.assembleCached((state_name, 'dR_df', arg_name),
+                                            state['dR_df'][arg_name],
+                                            state['compiled_dR_df'][arg_name],
+                                            dim=2)
             else:
                 dRdf = dR_df_list[arg_ind]
 
-            df = createFunction(args_dict[arg_name]['function'])
-            dRdf_dict[arg_name] = dict(dRdf=dRdf, df=df)
+            if arg_name not in dRdf_dict:
+                df = createFunction(args_dict[arg_name]['function'])
+                dRdf_dict[arg_name] = dict(dRdf=dRdf, df=df)
+            dRdf_dict[arg_name]['dRdf'] = dRdf
 
-        self.dRdf_dict = dRdf_dict
-        self.A,_ = assembleSystem(dR_du,
-                                state['residual_form'],
-                                bcs=self.bcs)
-        # self.A,_ = assembleSystem(dR_du,
-        #                         state['residual_form'],
-        #                         bcs=[])
+        # Reuse the Jacobian and factorization of the state solver if the
+        # derivatives are evaluated at the solution of the last solve
+        self.A, self.ksp = None, None
+        entry = self.getCachedEntry(inputs, outputs)
+        if entry is not None:
+            # The cached factorizations are kept in matrices owned by the
+            # cache entries, so they are not overwritten at other points;
+            # the matrix of an evicted entry is reused with its KSP, so
+            # that only the numeric factorization is redone
+            if entry['ksp'] is None:
+                A, ksp = self.solution_cache.takeSpare()
+                if A is None:
+                    A = assembleMatrix(state['compiled_dR_du'], bcs=self.bcs)
+                    ksp = self.fea.createStateKSP(state_name, A)
+                else:
+                    A.zeroEntries()
+                    assemble_matrix(A, state['compiled_dR_du'], bcs=self.bcs)
+                    A.assemble()
+                entry['A'], entry['ksp'] = A, ksp
+            self.A, self.ksp = entry['A'], entry['ksp']
+        else:
+            # Otherwise, A is reassembled in place only if it has changed,
+            # and its KSP refactors it at the next solve if needed
+            self.A, self.ksp = self.fea.getStateOperator(state_name,
+                            at_solution=self.atSolutionPoint(inputs, outputs))
+        # The transposed operator for the adjoint solves if the
+        # preconditioner can not be applied in transpose
+        self.A_T, self.ksp_T = None, None
         self.dR = self.state['d_residual']
         self.du = self.state['d_state']
-        if self.linear is True:
-            self.ksp = setUpKSP_MUMPS(self.A)
+        self.adjoint_rtol = self.adjointTolerance(inputs)
+        self.linearization_point = self.copyPoint(inputs, outputs)
+
+        # The solution of the multi-RHS adjoint solve in the orthonormal
+        # basis of the right-hand sides, computed at the first reverse solve
+        self.block_solution = None
+        self.block_pending = (self.fea.block_solve is True
+                                and self.A.getComm().getSize() == 1)
+
+
+    def addToHistory(self, inputs, outputs):
+        point = self.copyPoint(inputs, outputs)
+        if len(self.history) > 0:
+            last_inputs, _ = self.history[-1]
+            if all(np.array_equal(last_inputs[arg_name], point[arg_name])
+                    for arg_name in inputs):
+                self.history.pop()
+        self.history.append((dict((arg_name, point[arg_name])
+                                for arg_name in inputs),
+                            point[self.state_name]))
+
+    def predictState(self, inputs):
+        """
+        Predict the state at `inputs` from the last converged solutions
+        with the `fea.warm_start` mode; returns None if there is no
+        prediction to make
+        """
+        mode = self.fea.warm_start
+        if mode is None or self.linear or len(self.history) == 0:
+            return None
+        if mode == 'tangent':
+            return self.tangentPredictor(inputs)
+        elif mode == 'secant':
+            return self.secantPredictor(inputs)
+        else:
+            raise ValueError("Unsupported warm start mode: "+str(mode))
+
+    def tangentPredictor(self, inputs):
+        """
+        First-order prediction u + du with A du = -dR/df * df, using the
+        Jacobians and the factorization from the last `compute_derivatives`
+        if they were evaluated at the last solution
+        """
+        last_inputs, last_state = self.history[-1]
+        point = self.linearization_point
+        if (point is None or self.ksp is None
+                or not np.array_equal(point[self.state_name], last_state)
+                or not all(np.array_equal(point[arg_name], last_inputs[arg_name])
+                            for arg_name in inputs)):
+            return np.array(last_state)
+        if self.matrix_free:
+            # The actions are evaluated with the coefficients of the
+            # functions, so they are set back to the linearization point
+            current_state = np.copy(getFuncArray(self.state['function']))
+            for arg_name in inputs:
+                update(self.args_dict[arg_name]['function'], point[arg_name])
+            update(self.state['function'], point[self.state_name])
+        dR_array = np.zeros(self.state['shape'])
+        for arg_name in self.state['arguments']:
+            dR_array -= self.jacvecFwd(arg_name,
+                                        inputs[arg_name]-last_inputs[arg_name])
+        if self.matrix_free:
+            for arg_name in inputs:
+                update(self.args_dict[arg_name]['function'], inputs[arg_name])
+            update(self.state['function'], current_state)
+        # The Dirichlet dofs of the state are kept unchanged
+        setFuncArray(self.dR, dR_array)
+        setBCZero(self.dR.vector, self.bcs)
+        du_array = self.fea.solveLinearFwd(self.du, self.A, self.dR,
+                                            getFuncArray(self.dR), self.ksp)
+        return last_state + du_array
+
+    def secantPredictor(self, inputs):
+        """
+        Extrapolate the state linearly from the last solutions, fitting the
+        state differences to the input differences by least squares
+        """
+        last_inputs, last_state = self.history[-1]
+        if len(self.history) < 2:
+            return np.array(last_state)
+        arg_names = sorted(inputs)
+        dF = np.column_stack([np.concatenate([f[arg_name]-last_inputs[arg_name]
+                                    for arg_name in arg_names])
+                                for f, _ in list(self.history)[:-1]])
+        dU = np.column_stack([u-last_state
+                                for _, u in list(self.history)[:-1]])
+        df = np.concatenate([inputs[arg_name]-last_inputs[arg_name]
+                                for arg_name in arg_names])
+        c = np.linalg.lstsq(dF, df, rcond=None)[0]
+        return last_state + dU.dot(c)
+
+    def getCachedEntry(self, inputs, outputs):
+        """
+        Return the cache entry of the converged state at (inputs, outputs)
+        if the factorizations are cached, otherwise None
+        """
+        if self.solution_cache is None or not self.fea.cache_factorization:
+            return None
+        key = self.solution_cache.key(inputs)
+        entry = self.solution_cache.peek(key)
+        if entry is None:
+            return None
+        if not np.array_equal(entry['state'], outputs[self.state_name]):
+            return None
+        return entry
+
+    def copyPoint(self, inputs, outputs):
+        point = dict()
+        for arg_name in inputs:
+            point[arg_name] = np.array(inputs[arg_name])
+        point[self.state_name] = np.array(outputs[self.state_name])
+        return point
 
+    def atSolutionPoint(self, inputs, outputs):
+        """
+        Check if the inputs and the state are unchanged since the end of
+        the last `solve_residual_equations`
+        """
+        point = self.solution_point
+        if point is None:
+            return False
+        for arg_name in inputs:
+            if not np.array_equal(point[arg_name], inputs[arg_name]):
+                return False
+        return np.array_equal(point[self.state_name], outputs[self.state_name])
 
     def compute_jacvec_product(self, inputs, outputs,
                                 d_inputs, d_outputs, d_residuals, mode):
@@ -165,39 +371,144 @@ class StateOperation(CustomImplicitOperation):
             print("CSDL: Running compute_jacvec_product()..."+"mode "+str(mode))
             print("="*40)
 
-        ######################
-        # Might be redundant #
+        ########################
+        # Skipped if unchanged #
         for arg_name in inputs:
             update(self.args_dict[arg_name]['function'], inputs[arg_name])
         update(self.state['function'], outputs[self.state_name])
-        ######################
+        ########################
         state_name = self.state_name
-        args_dict = self.args_dict
+        arg_list = self.state['arguments']
         if mode == 'fwd':
             if state_name in d_residuals:
                 if state_name in d_outputs:
-                    update(self.du, d_outputs[state_name])
-                    d_residuals[state_name] += computeMatVecProductFwd(
-                            self.dRdu, self.du)
-                for arg_name in self.dRdf_dict:
+                    d_residuals[state_name] += self.jacvecFwd(state_name,
+                                                    d_outputs[state_name])
+                for arg_name in arg_list:
                     if arg_name in d_inputs:
-                        update(self.dRdf_dict[arg_name]['df'],
-                                d_inputs[arg_name])
-                        dRdf = self.dRdf_dict[arg_name]['dRdf']
-                        d_residuals[state_name] += computeMatVecProductFwd(
-                                dRdf, self.dRdf_dict[arg_name]['df'])
+                        d_residuals[state_name] += self.jacvecFwd(arg_name,
+                                                    d_inputs[arg_name])
 
         if mode == 'rev':
             if state_name in d_residuals:
-                update(self.dR, d_residuals[state_name])
                 if state_name in d_outputs:
-                    d_outputs[state_name] += computeMatVecProductBwd(
-                            self.dRdu, self.dR)
-                for arg_name in self.dRdf_dict:
+                    d_outputs[state_name] += self.jacvecBwd(state_name,
+                                                    d_residuals[state_name])
+                for arg_name in arg_list:
                     if arg_name in d_inputs:
-                        dRdf = self.dRdf_dict[arg_name]['dRdf']
-                        d_inputs[arg_name] += computeMatVecProductBwd(
-                                dRdf, self.dR)
+                        d_inputs[arg_name] += self.jacvecBwd(arg_name,
+                                                    d_residuals[state_name])
+
+    def jacvecFwd(self, arg_name, d_array):
+        """
+        Compute the product dR/d(arg) * d_array, where `arg_name` is the
+        state or one of its arguments
+        """
+        if self.matrix_free:
+            update(self.actions['d_args'][arg_name], d_array)
+            return np.copy(assembleVector(self.actions['fwd'][arg_name]))
+        if arg_name == self.state_name:
+            update(self.du, d_array)
+            return computeMatVecProductFwd(self.dRdu, self.du)
+        df = self.dRdf_dict[arg_name]['df']
+        update(df, d_array)
+        return computeMatVecProductFwd(self.dRdf_dict[arg_name]['dRdf'], df)
+
+    def jacvecBwd(self, arg_name, d_residual_array):
+        """
+        Compute the product dR/d(arg)^T * d_residual_array, where
+        `arg_name` is the state or one of its arguments
+        """
+        if self.matrix_free:
+            update(self.actions['d_residual'], d_residual_array)
+            return np.copy(assembleVector(self.actions['rev'][arg_name]))
+        update(self.dR, d_residual_array)
+        if arg_name == self.state_name:
+            return computeMatVecProductBwd(self.dRdu, self.dR)
+        return computeMatVecProductBwd(self.dRdf_dict[arg_name]['dRdf'],
+                                        self.dR)
+
+    def adjointTolerance(self, inputs):
+        """
+        Return the relative tolerance of the adjoint solves at `inputs` from
+        the loose-to-tight policy of `fea.adjoint_tolerances`, or None. The
+        tolerance follows the relative step of the inputs since the last
+        linearization, between the 'loose' tolerance (1e-2 by default) far
+        from the optimum and a tenth of the optimizer tolerances near it.
+        """
+        tolerances = self.fea.adjoint_tolerances
+        if tolerances is None:
+            return None
+        loose = tolerances.get('loose', 1e-2)
+        tight = 0.1*min(tolerances['feasibility'], tolerances['optimality'])
+        point = self.linearization_point
+        if point is None:
+            return loose
+        step_norm, input_norm = 0., 0.
+        for arg_name in inputs:
+            step_norm += np.sum((inputs[arg_name]-point[arg_name])**2)
+            input_norm += np.sum(point[arg_name]**2)
+        step = np.sqrt(step_norm/max(input_norm, np.finfo(float).tiny))
+        return min(loose, max(tight, step))
+
+    def getAdjointKSP(self):
+        """
+        Return the transposed Jacobian and its KSP for the adjoint solves
+        if the preconditioner of the state can not be applied in transpose,
+        otherwise (None, None); for the symmetric states, A^T = A and the
+        adjoint systems are solved with the factorization of A
+        """
+        if self.state['symmetric']:
+            return self.A, self.ksp
+        if supportsTransposeSolve(self.fea.getSolverOptions(self.state)):
+            return None, None
+        if self.ksp_T is None:
+            self.A_T, self.ksp_T = self.fea.getTransposedOperator(
+                                                self.state_name, self.A)
+        return self.A_T, self.ksp_T
+
+    def solveBlock(self, rhs_array):
+        """
+        Solve the adjoint systems of the columns of `rhs_array` with one
+        multi-RHS solve; the systems are solved on an orthonormal basis Q of
+        the columns, so that `apply_inverse_jacobian` returns X Q^T b for
+        every right-hand side b in their span without another solve
+        """
+        if rhs_array is None or rhs_array.shape[1] == 0:
+            return
+        Q, R, _ = scipy.linalg.qr(rhs_array, mode='economic', pivoting=True)
+        R_diag = np.abs(np.diag(R))
+        if R_diag[0] == 0.:
+            return
+        Q = Q[:, R_diag > 1e-12*R_diag[0]]
+        if self.ksp is None:
+            self.ksp = self.fea.createStateKSP(self.state_name, self.A)
+        A_T, ksp_T = self.getAdjointKSP()
+        if ksp_T is None:
+            with kspTolerances(self.ksp, self.adjoint_rtol):
+                X = self.fea.solveLinearBlock(self.A, Q, self.ksp,
+                                                transpose=True)
+        else:
+            with kspTolerances(ksp_T, self.adjoint_rtol):
+                X = self.fea.solveLinearBlock(A_T, Q, ksp_T)
+        self.block_solution = (Q, X)
+
+    def getBlockSolution(self, rhs):
+        """
+        Return the adjoint solution for `rhs` from the multi-RHS solve if
+        `rhs` is in the span of its right-hand sides, otherwise None
+        """
+        if self.block_pending:
+            self.block_pending = False
+            self.solveBlock(self.fea.getAdjointRHS(self.state_name))
+        if self.block_solution is None:
+            return None
+        Q, X = self.block_solution
+        coefficients = Q.T.dot(rhs)
+        rhs_norm = np.linalg.norm(rhs)
+        if np.linalg.norm(rhs-Q.dot(coefficients)) > 1e-10*rhs_norm:
+            return None
+        return X.dot(coefficients)
 
     def apply_inverse_jacobian(self, d_outputs, d_residuals, mode):
         if self.debug_mode == True:
@@ -206,13 +517,30 @@ class StateOperation(CustomImplicitOperation):
             print("="*40)
 
         state_name = self.state_name
+        if mode == 'rev':
+            solution = self.getBlockSolution(d_outputs[state_name])
+            if solution is not None:
+                d_residuals[state_name] = solution
+                return
+
+        if self.ksp is None:
+            self.ksp = self.fea.createStateKSP(state_name, self.A)
         if mode == 'fwd':
             d_outputs[state_name] = self.fea.solveLinearFwd(
                             self.du, self.A, self.dR,
                             d_residuals[state_name],
                             self.ksp)
+            return
+        A_T, ksp_T = self.getAdjointKSP()
+        if ksp_T is not None:
+            with kspTolerances(ksp_T, self.adjoint_rtol):
+                d_residuals[state_name] = self.fea.solveLinearFwd(
+                                self.dR, A_T, self.du,
+                                d_outputs[state_name],
+                                ksp_T)
         else:
-            d_residuals[state_name] = self.fea.solveLinearBwd(
-                            self.dR, self.A, self.du,
-                            d_outputs[state_name],
-                            self.ksp)
+            with kspTolerances(self.ksp, self.adjoint_rtol):
+                d_residuals[state_name] = self.fea.solveLinearBwd(
+                                self.dR, self.A, self.du,
+                                d_outputs[state_name],
+                                self.ksp)
@@ -82,10 +82,21 @@ class FEA(object):
         self.states_dict = dict()
         self.outputs_dict = dict()
         self.outputs_field_dict = dict()
+        self.field_output_space = None
         self.bc = []
+        # The assembled forms with the digests of their dependencies
+        self.assembled_forms = dict()
 
         self.PDE_SOLVER = "Newton"
         self.REPORT = True
+        # The default linear solver options of the states (see
+        # `configureKSP`), overridden by `solver_options` in `add_state`;
+        # the MUMPS controls from `mumpsOptions` also apply to the
+        # projections of the field outputs
+        self.solver_options = dict(ksp_type='preonly', pc_type='lu',
+                                    pc_factor_mat_solver_type='mumps')
+        # The options prefix of the KSPs that are not owned by a state
+        self.options_prefix = uniquePrefix('fea')
 
         self.ubc = None
         self.custom_solve = None
@@ -95,7 +106,40 @@ class FEA(object):
         self.initialize = False
         self.record = False
         self.recorder_path = "records"
+        # The states with residuals affine in the state are detected in
+        # `add_state`; set it to True to treat all states as linear, or
+        # use `linear` in `add_state` to override it per state
         self.linear_problem = False
+        # Predict the initial guess of the nonlinear states from the last
+        # converged solutions: None, 'tangent' or 'secant'
+        self.warm_start = None
+        # Number of the last (input, state) pairs kept for the prediction
+        self.warm_start_history = 3
+        # Number of converged states cached by each state operation for
+        # the repeated or nearby design points; 0 disables the cache
+        self.solution_cache_size = 0
+        # Keep the factorized Jacobians with the cached states as well
+        self.cache_factorization = False
+        # Solve the adjoint systems of the scalar outputs of a state with
+        # one multi-RHS solve at its first reverse-mode solve
+        self.block_solve = False
+        # Compute the Jacobian-vector products of the states with the
+        # assembled actions of their partials instead of storing the
+        # partial derivative matrices
+        self.matrix_free = False
+        # Reassemble and refactor the Jacobian of the SNES solvers only
+        # every `lag_jacobian` iterations, or when the residual norm is
+        # reduced by less than the factor `lag_stagnation` in an iteration
+        self.lag_jacobian = 1
+        self.lag_stagnation = 0.5
+        # Solve the Newton steps inexactly with the Eisenstat-Walker forcing
+        # terms as the tolerances of the iterative KSPs of the states
+        self.eisenstat_walker = False
+        # The feasibility and optimality tolerances of the optimizer, e.g.
+        # dict(feasibility=1e-6, optimality=1e-6), for the loose-to-tight
+        # tolerances of the adjoint solves with the iterative KSPs; None
+        # solves them to the tolerances of the KSPs
+        self.adjoint_tolerances = None
 
     def add_input(self, name, function, init_val=1.0, record=False):
         if name in self.inputs_dict:
@@ -110,7 +154,51 @@ class FEA(object):
         )
 
     def add_state(self, name, function, residual_form, arguments,
-                    dR_du=None, dR_df_list=None, record=False):
+                    dR_du=None, dR_df_list=None, record=False,
+                    solver_options=None, symmetric=False, linear=None):
+        """
+        Add the state with its residual form; the residual, its Jacobian and
+        the partial derivatives wrt the arguments are compiled once here and
+        reused for every assembly during the optimization.
+        `solver_options` sets the KSP type, the preconditioner and the
+        tolerances of the linear solves of the state over the FEA defaults,
+        e.g. dict(ksp_type='cg', pc_type='gamg', rtol=1e-10); its 'prefix'
+        is the PETSc options prefix of the state, `name` with a number
+        unique in the process by default (a given prefix must be unique
+        too, as the options are kept in the global database), and
+        its 'fields' is the dictionary of the subspaces of the state space
+        for the 'fieldsplit' preconditioner, e.g. dict(u=W.sub(0),
+        theta=W.sub(1)) with the options from `fieldSplitOptions`. The
+        MUMPS controls of the LU factorizations are given by `mumpsOptions`,
+        e.g. mumpsOptions(blr_tol=1e-8, num_threads=4). With `symmetric`,
+        the Jacobian of the state is taken as symmetric: it is factorized
+        by MUMPS with LDL^T (Cholesky) instead of LU, and the adjoint
+        systems are solved with the same factorization. `linear` overrides
+        the detection of the affine residuals by `isAffine` (and the FEA
+        setting `linear_problem`): True solves the state with one linear
+        solve, False always with the nonlinear solver.
+        """
+        if linear is None:
+            linear = (self.linear_problem
+                        or isAffine(residual_form, function))
+        if dR_du is None:
+            dR_du = computePartials(residual_form, function)
+        dR_df = dict()
+        compiled_dR_df = dict()
+        if dR_df_list is None:
+            for argument in arguments:
+                dR_df[argument] = computePartials(residual_form,
+                                    self.inputs_dict[argument]['function'])
+                compiled_dR_df[argument] = compileForm(dR_df[argument])
+
+        options_prefix = uniquePrefix(name)
+        fields = None
+        if solver_options is not None:
+            solver_options = dict(solver_options)
+            options_prefix = solver_options.pop('prefix', options_prefix)
+            if 'fields' in solver_options:
+                fields = createFieldSplit(function.function_space,
+                                            solver_options.pop('fields'))
 
         self.states_dict[name] = dict(
             function=function,
@@ -121,41 +209,95 @@ class FEA(object):
             d_state=Function(function.function_space),
             dR_du=dR_du,
             dR_df_list=dR_df_list,
+            dR_df=dR_df,
+            compiled_residual=compileForm(residual_form),
+            compiled_dR_du=compileForm(dR_du),
+            compiled_dR_df=compiled_dR_df,
+            linear=linear,
+            symmetric=symmetric,
+            nonlinear_solver=None,
+            nonlinear_solver_type=None,
+            solver_at_solution=False,
             arguments=arguments,
+            solver_options=solver_options,
+            options_prefix=options_prefix,
+            fields=fields,
+            near_nullspace=buildNearNullspace(function.function_space),
+            ksp=None,
+            ksp_rtol=None,
+            A_T=None,
+            A_T_source=None,
+            ksp_T=None,
+            actions=None,
             recorder=self.createRecorder(name, record),
             record=record
         )
 
     def add_output(self, name, type, form, arguments):
+        """
+        Add the scalar or field output; the output form and its partial
+        derivatives wrt the arguments are compiled once here
+        """
+        compiled_form = compileForm(form)
         if type == 'field':
-            shape = len(getFormArray(form))
+            shape = len(assembleVector(compiled_form))
         elif type == 'scalar':
             shape = 1
-        partials = []
+        partials = dict()
+        compiled_partials = dict()
         for argument in arguments:
             if argument in self.inputs_dict:
                 partial = derivative(form, self.inputs_dict[argument]['function'])
             elif argument in self.states_dict:
                 partial = derivative(form, self.states_dict[argument]['function'])
-            partials.append(partial)
+            partials[argument] = partial
+            compiled_partials[argument] = compileForm(partial)
         self.outputs_dict[name] = dict(
             form=form,
+            compiled_form=compiled_form,
             shape=shape,
             arguments=arguments,
             partials=partials,
+            compiled_partials=compiled_partials,
         )
 
-    def add_field_output(self, name, form, arguments, record=False):
-
-        V = FunctionSpace(self.mesh, ("CG", 1))
+    def add_field_output(self, name, form, arguments, record=False,
+                            lump_mass=False):
+        """
+        Add the field output as the L2 projection of the UFL expression
+        `form` to a CG1 function; the projection forms and the partials of
+        its right-hand side wrt the arguments are compiled once here.
+        With `lump_mass`, the projection uses the lumped mass matrix and
+        its partials M^{-1} dL/darg are sparse; with the consistent mass, the
+        output is differentiated as the solution of M y = L instead, whose
+        partials M and dL/darg are sparse.
+        """
+        # The field outputs share one CG1 space, and so the factorization
+        # of its mass matrix
+        if self.field_output_space is None:
+            self.field_output_space = FunctionSpace(self.mesh, ("CG", 1))
+        V = self.field_output_space
         output_func = Function(V)
-        partials = []
+        a, L = projectionForms(form, V, lump_mass)
+        partials = dict()
+        compiled_partials = dict()
+        for argument in arguments:
+            if argument in self.inputs_dict:
+                partial = derivative(L, self.inputs_dict[argument]['function'])
+            elif argument in self.states_dict:
+                partial = derivative(L, self.states_dict[argument]['function'])
+            partials[argument] = partial
+            compiled_partials[argument] = compileForm(partial)
         self.outputs_field_dict[name] = dict(
             form=form,
             func=output_func,
             shape=len(getFuncArray(output_func)),
             arguments=arguments,
             partials=partials,
+            compiled_partials=compiled_partials,
+            lump_mass=lump_mass,
+            projection=(a, L),
+            compiled_projection=(compileForm(a), compileForm(L)),
             recorder=self.createRecorder(name, record),
             record=record
         )
@@ -175,19 +317,162 @@ class FEA(object):
             for locate_BC in locate_BC_list:
                 self.bc.append(dirichletbc(ubc, locate_BC, function_space))
 
-    def solve(self, res, func, bc):
+    def solve(self, res, func, bc, initialize=None):
         """
-        Solve the PDE problem
+        Solve the PDE problem; `initialize` overrides the FEA setting for
+        the initial guess, e.g. with False to start from the current `func`
         """
         solver_type=self.PDE_SOLVER
         report=self.REPORT
-        initialize=self.initialize
+        if initialize is None:
+            initialize=self.initialize
+        state = self.findState(res,func)
         if self.custom_solve is not None and self.initial_solve == True:
             self.custom_solve(res,func,bc,report)
             # self.initial_solve = False
+            if state is not None:
+                state['solver_at_solution'] = False
         else:
-            solveNonlinear(res,func,bc,solver_type,report,initialize)
+            nonlinear_solver = self.getNonlinearSolver(res,func,bc)
+            if nonlinear_solver is not None:
+                solver_type = state['nonlinear_solver_type']
+            solveNonlinear(res,func,bc,solver_type,report,initialize,
+                            nonlinear_solver=nonlinear_solver)
+            if state is not None:
+                state['solver_at_solution'] = True
+
+    def findState(self, res, func):
+        """
+        Find the state with the residual `res` and function `func`
+        """
+        for state in self.states_dict.values():
+            if state['function'] is func and state['residual_form'] is res:
+                return state
+        return None
+
+    def getNonlinearSolver(self, res, func, bc):
+        """
+        Return the persistent solver of the state with the residual `res`
+        and function `func`. It is created with the precompiled forms at
+        the first call and reused afterwards, so that the solver setup is
+        paid once per run. The states with affine residuals are solved with
+        a single linear solve regardless of `PDE_SOLVER`. Returns None if
+        `res` is not the residual of a state in this FEA.
+        """
+        state = self.findState(res, func)
+        if state is None:
+            return None
+        solver_type = self.PDE_SOLVER
+        if state['linear'] is True:
+            solver_type = 'Affine'
+        if state['nonlinear_solver_type'] != solver_type:
+            state['nonlinear_solver'] = createNonlinearSolver(
+                                        state['compiled_residual'],
+                                        func, bc, solver_type,
+                                        self.REPORT,
+                                        J=state['compiled_dR_du'],
+                                        ksp_options=self.getSolverOptions(state),
+                                        options_prefix=state['options_prefix'],
+                                        fields=state['fields'],
+                                        lag_jacobian=self.lag_jacobian,
+                                        lag_stagnation=self.lag_stagnation,
+                                        eisenstat_walker=self.eisenstat_walker)
+            state['nonlinear_solver_type'] = solver_type
+            # The forcing terms overwrite the KSP tolerance during the solves
+            state['ksp_rtol'] = getSolverKSP(state['nonlinear_solver'],
+                                                solver_type).getTolerances()[0]
+            self.prepareOperator(state,
+                    getSolverMatrix(state['nonlinear_solver'], solver_type))
+        return state['nonlinear_solver']
+
+
+    def getSolverOptions(self, state):
+        """
+        Return the linear solver options of `state` over the FEA defaults
+        """
+        options = dict(self.solver_options)
+        if state['solver_options'] is not None:
+            options.update(state['solver_options'])
+        if state['symmetric'] and options.get('pc_type') == 'lu':
+            options['pc_type'] = 'cholesky'
+        return options
+
+    def createStateKSP(self, state_name, A):
+        """
+        Create the KSP of the linear systems of the state with the operator
+        A, configured by the solver options of the state
+        """
+        state = self.states_dict[state_name]
+        self.prepareOperator(state, A)
+        return createKSP(A, self.getSolverOptions(state),
+                            state['options_prefix'], state['fields'])
+
+    def prepareOperator(self, state, A):
+        """
+        Attach the rigid-body modes of the state, if any, to the operator A,
+        and mark A as symmetric for the symmetric states
+        """
+        if state['near_nullspace'] is not None:
+            A.setNearNullSpace(state['near_nullspace'])
+        if state['symmetric']:
+            setSymmetric(A)
 
+    def getStateActions(self, state_name):
+        """
+        Return the compiled actions of the partials of the state residual
+        on the functions `d_args` (the state and its arguments) for the
+        forward products, and of their adjoints on `d_residual` for the
+        reverse products; they are compiled at the first call
+        """
+        state = self.states_dict[state_name]
+        if state['actions'] is None:
+            d_state, d_residual = state['d_state'], state['d_residual']
+            d_args = {state_name: d_state}
+            fwd = {state_name: ufl.action(state['dR_du'], d_state)}
+            rev = {state_name: ufl.action(ufl.adjoint(state['dR_du']),
+                                            d_residual)}
+            for arg_name in state['arguments']:
+                df = Function(self.inputs_dict[arg_name]['function_space'])
+                d_args[arg_name] = df
+                fwd[arg_name] = ufl.action(state['dR_df'][arg_name], df)
+                rev[arg_name] = ufl.action(
+                                    ufl.adjoint(state['dR_df'][arg_name]),
+                                    d_residual)
+            state['actions'] = dict(
+                d_args=d_args,
+                d_residual=d_residual,
+                fwd=dict((name, compileForm(f)) for name, f in fwd.items()),
+                rev=dict((name, compileForm(f)) for name, f in rev.items()),
+            )
+        return state['actions']
+
+    def getConvergedJacobian(self, state_name):
+        """
+        Return the Jacobian matrix with the strong BCs and the KSP of the
+        persistent solver of the state, at the solution of its last solve.
+        The factorization of the affine solver is exact at the solution and
+        is reused directly; for the Newton/SNES solvers, the Jacobian is
+        reassembled at the converged state into the matrix of the solver, so
+        that its KSP refactors it once. Returns (None, None) if the state
+        has no persistent solver to reuse.
+        """
+        state = self.states_dict[state_name]
+        solver = state['nonlinear_solver']
+        solver_type = state['nonlinear_solver_type']
+        if solver is None:
+            return None, None
+        A = getSolverMatrix(solver, solver_type)
+        if solver_type == 'Affine':
+            if state['solver_at_solution'] is not True:
+                return None, None
+            return A, solver.ksp
+        ksp = getSolverKSP(solver, solver_type)
+        # Reset the tolerance from the last forcing term of the solve
+        ksp.setTolerances(rtol=state['ksp_rtol'])
+        A.zeroEntries()
+        assemble_matrix(A, state['compiled_dR_du'], bcs=self.bc)
+        A.assemble()
+        return A, ksp
 
     def solveLinearFwd(self, du, A, dR, dR_array, ksp=None):
         """
@@ -198,9 +483,11 @@ class FEA(object):
         du.vector.set(0.0)
         if ksp is None:
             # solveKSP(A, dR.vector, du.vector)
-            solveKSP_mumps(transpose(A), du.vector, dR.vector)
+            solveKSP_mumps(A, dR.vector, du.vector,
+                            options=self.solver_options,
+                            prefix=self.options_prefix)
         else:
-            ksp.solve(du.vector, dR.vector)
+            ksp.solve(dR.vector, du.vector)
         du.vector.assemble()
         du.vector.ghostUpdate()
         return du.vector.getArray()
@@ -208,22 +495,362 @@ class FEA(object):
     def solveLinearBwd(self, dR, A, du, du_array, ksp=None):
         """
         solve linear system du = dR_du.T (A_T) * dR in DOLFIN type
+        with the transpose solve of the factorization of A
         """
         setFuncArray(du, du_array)
 
         dR.vector.set(0.0)
         if ksp is None:
-            # solveKSP(transpose(A), du.vector, dR.vector)
-            solveKSP_mumps(transpose(A), du.vector, dR.vector)
+            solveKSP_mumps(A, du.vector, dR.vector, transpose=True,
+                            options=self.solver_options,
+                            prefix=self.options_prefix)
         else:
-            ksp.solve(du.vector, dR.vector)
+            ksp.solveTranspose(du.vector, dR.vector)
         dR.vector.assemble()
         dR.vector.ghostUpdate()
         return dR.vector.getArray()
 
-    def projectFieldOutput(self,form,func):
-        project(form, func, lump_mass=False)
+    def solveLinearBlock(self, A, B_array, ksp=None, transpose=False):
+        """
+        Solve A X = B (or A^T X = B with `transpose`) for all the columns
+        of the 2D array `B_array` together, with one multi-RHS solve on the
+        factorization of the KSP; the columns are solved one at a time if
+        the KSP does not support the blocked solves; without `ksp`, A is
+        factorized for this solve only. The rows of `B_array` (and of the
+        returned X) are the rows of A owned by this process.
+        """
+        owned_ksp = None
+        if ksp is None:
+            ksp = owned_ksp = setUpKSP_MUMPS(A, self.solver_options,
+                                                self.options_prefix)
+        num_rows, num_cols = B_array.shape
+        B = PETSc.Mat().createDense(((num_rows, PETSc.DECIDE), num_cols),
+                                    comm=A.getComm())
+        B.setUp()
+        row_start, row_end = A.getOwnershipRange()
+        B.setValues(range(row_start, row_end), range(num_cols), B_array)
+        B.assemble()
+        X = B.duplicate()
+        try:
+            if transpose:
+                ksp.matSolveTranspose(B, X)
+            else:
+                ksp.matSolve(B, X)
+            X_array = np.copy(X.getDenseArray())
+        except (AttributeError, PETSc.Error):
+            b, x = A.createVecs()
+            X_array = np.zeros_like(B_array)
+            for j in range(num_cols):
+                b.setArray(B_array[:, j])
+                if transpose:
+                    ksp.solveTranspose(b, x)
+                else:
+                    ksp.solve(b, x)
+                X_array[:, j] = x.getArray()
+        B.destroy()
+        X.destroy()
+        if owned_ksp is not None:
+            owned_ksp.destroy()
+        return X_array
+
+    def getAdjointRHS(self, state_name):
+        """
+        Return the partial derivatives wrt the state of the scalar outputs
+        that depend on it, as the columns of an array
+        """
+        columns = []
+        for output_name, output in self.outputs_dict.items():
+            if output['shape'] != 1 or state_name not in output['partials']:
+                continue
+            columns.append(self.assembleCached(
+                                (output_name, 'partial', state_name, 1),
+                                output['partials'][state_name],
+                                output['compiled_partials'][state_name],
+                                dim=1))
+        if len(columns) == 0:
+            return None
+        return np.column_stack(columns)
+
+    def solveStates(self):
+        """
+        Solve all the states of the FEA at the current inputs
+        """
+        for state in self.states_dict.values():
+            self.solve(state['residual_form'], state['function'], self.bc)
+
+    def getStateOperator(self, state_name, at_solution=True):
+        """
+        Return the Jacobian of the state with the strong BCs at its current
+        solution and a KSP for it; the factorization of the state solver is
+        reused if possible and `at_solution`, otherwise the Jacobian is
+        assembled into a persistent matrix with its own KSP
+        """
+        if at_solution:
+            A, ksp = self.getConvergedJacobian(state_name)
+            if A is not None:
+                return A, ksp
+        state = self.states_dict[state_name]
+        A = self.assembleCached((state_name, 'A'), state['dR_du'],
+                                state['compiled_dR_du'], dim=2, bcs=self.bc)
+        if state['ksp'] is None:
+            state['ksp'] = self.createStateKSP(state_name, A)
+        return A, state['ksp']
+
+    def getTransposedOperator(self, state_name, A):
+        """
+        Return the transpose of the state operator A with a KSP for it, for
+        the adjoint solves when the preconditioner of the state can not be
+        applied in transpose. The transposed matrix and its KSP are kept per
+        state; if A is the operator of the last call, its transpose is
+        overwritten in place, so that the KSP keeps the symbolic analysis
+        and only refactors the new values.
+        """
+        state = self.states_dict[state_name]
+        if state['ksp_T'] is not None and state['A_T_source'] is A:
+            transpose(A, state['A_T'])
+        else:
+            state['A_T'] = transpose(A)
+            state['A_T_source'] = A
+            state['ksp_T'] = self.createStateKSP(state_name, state['A_T'])
+        return state['A_T'], state['ksp_T']
+
+    def compute_total_derivatives(self, outputs, wrt):
+        """
+        Compute the total derivatives of the scalar outputs wrt the inputs
+        `wrt` at the current solutions of the states, as a dictionary of
+        {output: {input: gradient}}. For each state, the adjoint systems
+        A^T lambda = dJ/du of all the outputs are solved together, and the
+        gradients are dJ/df - dR/df^T lambda.
+        """
+        if isinstance(outputs, str):
+            outputs = [outputs]
+        if isinstance(wrt, str):
+            wrt = [wrt]
+        for output_name in outputs:
+            if self.outputs_dict[output_name]['shape'] != 1:
+                raise ValueError("Total derivatives are only available for "
+                                 "scalar outputs; '"+output_name+"' is not.")
+        totals = dict()
+        for output_name in outputs:
+            output = self.outputs_dict[output_name]
+            totals[output_name] = dict()
+            for arg_name in wrt:
+                if arg_name in output['partials']:
+                    totals[output_name][arg_name] = self.assembleCached(
+                                    (output_name, 'partial', arg_name, 1),
+                                    output['partials'][arg_name],
+                                    output['compiled_partials'][arg_name],
+                                    dim=1)
+                else:
+                    totals[output_name][arg_name] = np.zeros(
+                                    self.inputs_dict[arg_name]['shape'])
+
+        for state_name, state in self.states_dict.items():
+            output_names = [output_name for output_name in outputs
+                    if state_name in self.outputs_dict[output_name]['partials']]
+            arg_names = [arg_name for arg_name in wrt
+                            if arg_name in state['arguments']]
+            if len(output_names) == 0 or len(arg_names) == 0:
+                continue
+            if any(arg_name in self.states_dict
+                        for arg_name in state['arguments']):
+                raise ValueError("Total derivatives of coupled states are "
+                                 "not supported; '"+state_name+"' depends "
+                                 "on another state.")
+            # The adjoint solutions vanish on the Dirichlet dofs, where the
+            # residual does not depend on the inputs
+            dJdu = np.zeros((state['shape'], len(output_names)))
+            for j, output_name in enumerate(output_names):
+                output = self.outputs_dict[output_name]
+                setFuncArray(state['d_state'], self.assembleCached(
+                                    (output_name, 'partial', state_name, 1),
+                                    output['partials'][state_name],
+                                    output['compiled_partials'][state_name],
+                                    dim=1))
+                setBCZero(state['d_state'].vector, self.bc)
+                dJdu[:, j] = getFuncArray(state['d_state'])
+
+            A, ksp = self.getStateOperator(state_name)
+            transpose = not state['symmetric']
+            if transpose and not supportsTransposeSolve(
+                                    self.getSolverOptions(state)):
+                A, ksp = self.getTransposedOperator(state_name, A)
+                transpose = False
+            if A.getComm().getSize() == 1:
+                adjoints = self.solveLinearBlock(A, dJdu, ksp,
+                                                 transpose=transpose)
+            else:
+                # One solve per output with the factorization kept in ksp
+                adjoints = np.zeros_like(dJdu)
+                for j in range(len(output_names)):
+                    if transpose:
+                        adjoints[:, j] = self.solveLinearBwd(
+                                    state['d_residual'], A, state['d_state'],
+                                    dJdu[:, j], ksp)
+                    else:
+                        adjoints[:, j] = self.solveLinearFwd(
+                                    state['d_residual'], A, state['d_state'],
+                                    dJdu[:, j], ksp)
+
+            if self.matrix_free and state['dR_df_list'] is None:
+                actions = self.getStateActions(state_name)
+                for j, output_name in enumerate(output_names):
+                    setFuncArray(actions['d_residual'], adjoints[:, j])
+                    for arg_name in arg_names:
+                        totals[output_name][arg_name] -= assembleVector(
+                                    actions['rev'][arg_name])
+                continue
+            for arg_name in arg_names:
+                arg_ind = state['arguments'].index(arg_name)
+                if state['dR_df_list'] is None:
+                    dRdf = self.assembleCached(
+                                    (state_name, 'dR_df', arg_name),
+                                    state['dR_df'][arg_name],
+                                    state['compiled_dR_df'][arg_name],
+                                    dim=2)
+                else:
+                    dRdf = state['dR_df_list'][arg_ind]
+                for j, output_name in enumerate(output_names):
+                    setFuncArray(state['d_residual'], adjoints[:, j])
+                    totals[output_name][arg_name] -= computeMatVecProductBwd(
+                                    dRdf, state['d_residual'])
+        return totals
+
+    def projectFieldOutput(self, name):
+        """
+        Project the field output `name` with its precompiled forms; the
+        projection is skipped if the projected expression is unchanged
+        """
+        output = self.outputs_field_dict[name]
+        digest = formDigest(output['projection'][1])
+        key = (name, 'projection')
+        if key in self.assembled_forms:
+            if self.assembled_forms[key]['digest'] == digest:
+                return
+        operator = self.getProjectionOperator(name)
+        operator.solve(output['compiled_projection'][1], output['func'])
+        self.assembled_forms[key] = dict(value=None, digest=digest)
+
+    def getProjectionOperator(self, name):
+        """
+        Return the cached projection operator, with the mass matrix and its
+        factorization or the lumped mass vector, of the field output `name`
+        """
+        output = self.outputs_field_dict[name]
+        return getProjectionOperator(output['func'].function_space,
+                                        lump_mass=output['lump_mass'],
+                                        solver_options=self.solver_options)
 
+    def assembleFieldOutputPartial(self, name, arg_name):
+        """
+        Assemble the partial derivative matrix of the right-hand side of
+        the projection of the field output `name` wrt `arg_name`
+        """
+        output = self.outputs_field_dict[name]
+        return self.assembleCached((name, 'partial', arg_name, 2),
+                                    output['partials'][arg_name],
+                                    output['compiled_partials'][arg_name],
+                                    dim=2)
+
+    def computeFieldOutputPartial(self, name, arg_name):
+        """
+        Compute the derivative M^{-1} dL/darg of the projected field output
+        `name` wrt `arg_name` for the lumped mass M; returns the values in
+        the CSR order of dL/darg, which has the same sparsity
+        """
+        operator = self.getProjectionOperator(name)
+        if not operator.lump_mass:
+            raise ValueError("The partials of the field output "+name+
+                        " are only formed with the lumped mass; the "
+                        "consistent mass is differentiated implicitly")
+        dLdf = self.assembleFieldOutputPartial(name, arg_name)
+        ai, aj, values = dLdf.getValuesCSR()
+        rows = np.repeat(np.arange(len(ai)-1), np.diff(ai))
+        return values/operator.M.getArray()[rows]
+
+    def fieldOutputResidual(self, name, output_array):
+        """
+        Evaluate the residual M y - L of the projection of the field output
+        `name` at the projected values y = `output_array`
+        """
+        output = self.outputs_field_dict[name]
+        L = self.assembleCached((name, 'rhs'),
+                                output['projection'][1],
+                                output['compiled_projection'][1],
+                                dim=1)
+        return self.jacvecFieldOutput(name, name, output_array, 'fwd') - L
+
+    def jacvecFieldOutput(self, name, arg_name, d_array, mode):
+        """
+        Compute the product of the partial derivative of the projection
+        residual M y - L of the field output `name` wrt `arg_name`, i.e. the
+        mass matrix M for the output itself or -dL/darg for an argument,
+        with `d_array` for `mode`='fwd', or of its transpose for 'rev'
+        """
+        if arg_name == name:
+            A, sign = self.getProjectionOperator(name).M, 1.
+        else:
+            A, sign = self.assembleFieldOutputPartial(name, arg_name), -1.
+        x, y = A.createVecs()
+        if mode == 'fwd':
+            x.setArray(d_array)
+            A.mult(x, y)
+            product = sign*y.getArray()
+        else:
+            y.setArray(d_array)
+            A.multTranspose(y, x)
+            product = sign*x.getArray()
+        x.destroy()
+        y.destroy()
+        return product
+
+    def solveFieldOutput(self, name, rhs_array):
+        """
+        Solve M x = `rhs_array` with the cached factorization of the mass
+        matrix of the field output `name`; M is symmetric, so the adjoint
+        systems are solved the same way
+        """
+        operator = self.getProjectionOperator(name)
+        x, b = operator.M.createVecs()
+        b.setArray(rhs_array)
+        operator.applyInverse(b, x)
+        solution = np.copy(x.getArray())
+        x.destroy()
+        b.destroy()
+        return solution
+
+    def assembleCached(self, key, ufl_form, compiled_form, dim, bcs=[]):
+        """
+        Assemble the compiled form of `ufl_form` as a scalar (dim=0), an
+        array (dim=1) or a PETSc matrix (dim=2) under the name `key`. The
+        assembly is skipped if the coefficients that `ufl_form` actually
+        depends on are unchanged since the last assembly of `key`, so the
+        constant forms are assembled once, and the matrices are reassembled
+        in place.
+        """
+        cached = self.assembled_forms.get(key)
+        if cached is None:
+            dependencies = formDependencies(ufl_form)
+        else:
+            dependencies = cached['dependencies']
+        digest = formDigest(ufl_form, dependencies)
+        if cached is not None and cached['digest'] == digest:
+            value = cached['value']
+        elif dim == 2:
+            if cached is None:
+                value = assembleMatrix(compiled_form, bcs=bcs)
+            else:
+                value = cached['value']
+                value.zeroEntries()
+                assemble_matrix(value, compiled_form, bcs=bcs)
+                value.assemble()
+        else:
+            value = assemble(compiled_form, dim=dim)
+        self.assembled_forms[key] = dict(value=value, digest=digest,
+                                            dependencies=dependencies)
+        if dim == 1:
+            return np.copy(value)
+        return value
 
     def createRecorder(self, name, record=False):
         recorder = None
@@ -15,7 +15,7 @@ from dolfinx.fem import (form, assemble_scalar, Function, FunctionSpace,
                         dirichletbc, locate_dofs_geometrical, Constant)
 from dolfinx.fem.petsc import (assemble_vector, assemble_matrix,
                         NonlinearProblem, apply_lifting, set_bc,
-                        create_matrix, _assemble_matrix_mat,)
+                        create_matrix, create_vector, _assemble_matrix_mat,)
 from dolfinx.nls.petsc import NewtonSolver as PETScNewtonSolver
 from dolfinx import la
 from petsc4py import PETSc
@@ -24,7 +24,13 @@ from mpi4py import MPI
 import numpy as np
 from scipy.spatial import KDTree
 from configparser import ConfigParser
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
+import hashlib
+import itertools
+import os
 import ufl 
+from ufl.algorithms import expand_derivatives
 
 from scipy.spatial import KDTree
 
@@ -166,23 +172,210 @@ def setFuncArray(v, v_array):
     v.vector.assemble()
     v.vector.ghostUpdate()
 
+class ObjectCache(object):
+    """
+    Bounded LRU cache with keys made of the identities of objects. The
+    objects of a key are kept alive with its entry, so that their
+    identities can not be reused by other objects while it is cached.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key):
+        """
+        Return the cached value of `key`, or None
+        """
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][1]
+        self.misses += 1
+        return None
+
+    def insert(self, key, objects, value):
+        """
+        Cache `value` under `key`, keeping alive the `objects` whose
+        identities are in the key
+        """
+        self.entries[key] = (objects, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.evict(evicted)
+            self.evictions += 1
+        return value
+
+    def evict(self, value):
+        """
+        Release the `value` of an entry evicted from the cache
+        """
+        pass
+
+    def clear(self):
+        self.entries.clear()
+
+    def info(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, size=len(self.entries),
+                    maxsize=self.maxsize)
+
+class FormCache(ObjectCache):
+    """
+    Bounded LRU cache of the compiled DOLFINx forms. The key is the UFL
+    form signature together with the identities of the coefficients,
+    constants, domains and subdomain data that the form is bound to, so
+    that assembling the same expression repeatedly skips the form
+    construction entirely.
+    """
+    def key(self, f):
+        subdomain_data = []
+        for domain_data in f.subdomain_data().values():
+            for integral_type, data in domain_data.items():
+                subdomain_data.append((integral_type, id(data)))
+        return (f.signature(),
+                tuple(id(c) for c in f.coefficients()),
+                tuple(id(c) for c in f.constants()),
+                tuple(id(d) for d in f.ufl_domains()),
+                tuple(sorted(subdomain_data)))
+
+    def get(self, f):
+        """
+        Return the compiled form of `f`; compiled forms (or lists of them)
+        are passed through to `form` unchanged
+        """
+        if not isinstance(f, ufl.Form):
+            return form(f)
+        key = self.key(f)
+        compiled_form = self.lookup(key)
+        if compiled_form is None:
+            compiled_form = self.insert(key, f, form(f))
+        return compiled_form
+
+form_cache = FormCache()
+
+def cachedForm(f):
+    """
+    Compile the UFL form through the module-level LRU form cache
+    """
+    return form_cache.get(f)
+
+class ExpressionCache(ObjectCache):
+    """
+    Bounded LRU cache of the compiled DOLFINx expressions for the
+    interpolation. As in `FormCache`, the key is the UFL representation of
+    the expression with the identities of its coefficients and constants,
+    together with the target function space.
+    """
+    def key(self, v, V):
+        return (repr(v),
+                tuple(id(c) for c in ufl.algorithms.extract_coefficients(v)),
+                tuple(id(c) for c in
+                        ufl.algorithms.analysis.extract_constants(v)),
+                id(V))
+
+    def get(self, v, V):
+        """
+        Return the compiled expression of `v` at the interpolation points
+        of the element of `V`
+        """
+        key = self.key(v, V)
+        expression = self.lookup(key)
+        if expression is None:
+            points = V.element.interpolation_points
+            # a method in some DOLFINx versions and a property in the others
+            if callable(points):
+                points = points()
+            expression = self.insert(key, (v, V),
+                                dolfinx.fem.Expression(v, points))
+        return expression
+
+class SolutionCache(ObjectCache):
+    """
+    Bounded LRU cache of the converged solutions of a state, keyed by the
+    digest of the input arrays. Each entry keeps copies of the inputs and
+    the state, and optionally the Jacobian matrix with its factorized KSP.
+    The matrices of the evicted entries are kept as spares for the new
+    entries, so that their KSPs keep the symbolic factorization.
+    """
+    def __init__(self, maxsize=8):
+        super().__init__(maxsize)
+        self.spares = []
+
+    def key(self, inputs):
+        digest = hashlib.blake2b(digest_size=16)
+        for name in sorted(inputs):
+            digest.update(name.encode())
+            digest.update(np.ascontiguousarray(inputs[name]).tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        return self.lookup(key)
+
+    def peek(self, key):
+        """
+        Return the entry of `key`, or None, without counting the access
+        """
+        if key in self.entries:
+            return self.entries[key][1]
+        return None
+
+    def put(self, key, inputs, state):
+        entry = dict(inputs={name: np.array(inputs[name]) for name in inputs},
+                    state=np.array(state), A=None, ksp=None)
+        return self.insert(key, None, entry)
+
+    def evict(self, entry):
+        if entry['ksp'] is not None:
+            self.spares.append((entry['A'], entry['ksp']))
+
+    def takeSpare(self):
+        """
+        Return a spare (A, ksp) from the evicted entries, or (None, None)
+        """
+        if len(self.spares) == 0:
+            return None, None
+        return self.spares.pop()
+
+    def closest(self, inputs):
+        """
+        Return the entry with the inputs closest to `inputs` in the
+        Euclidean norm, or None if the cache is empty
+        """
+        closest_entry = None
+        min_distance = np.inf
+        for _, entry in self.entries.values():
+            distance = 0.
+            for name in inputs:
+                distance += np.sum((entry['inputs'][name]-inputs[name])**2)
+            if distance < min_distance:
+                closest_entry, min_distance = entry, distance
+        return closest_entry
+
+    def clear(self):
+        super().clear()
+        self.spares.clear()
+
 def assembleScalar(c):
     """
     Compute the array representation of the scalar form
     """
-    return assemble_scalar(form(c))
+    return assemble_scalar(cachedForm(c))
 
 def assembleVector(v):
     """
     Compute the array representation of the vector form
     """
-    return assemble_vector(form(v)).array
+    return assemble_vector(cachedForm(v)).array
 
 def assembleMatrix(M, bcs=[]):
     """
     Compute the array representation of the matrix form
     """
-    M_ = assemble_matrix(form(M), bcs=bcs)
+    M_ = assemble_matrix(cachedForm(M), bcs=bcs)
     M_.assemble()
     return M_
 
@@ -190,11 +383,10 @@ def assembleSystem(J, F, bcs=[]):
     """
     Compute the array representations of the linear system
     """
-    a = form(J)
-    L = form(F)
+    a = cachedForm(J)
     A = assemble_matrix(a, bcs=bcs)
     A.assemble()
-    L = form(F)
+    L = cachedForm(F)
     b = assemble_vector(L)
     apply_lifting(b, [a], [bcs])
     b.ghostUpdate(PETSc.InsertMode.ADD_VALUES, PETSc.ScatterMode.REVERSE)
@@ -238,11 +430,22 @@ def errorNorm(v, v_ex, norm='L2'):
 
 
 ##### Linear algebra
-def transpose(A):
+def transpose(A, A_T=None):
+    """
+    Transpose for matrix of DOLFIN type; if `A_T` is a previous transpose
+    of A, it is overwritten in place with the same nonzero pattern
     """
-    Transpose for matrix of DOLFIN type
+    if A_T is None:
+        A_T = PETSc.Mat(MPI.COMM_WORLD)
+    return A.transpose(A_T)
+
+def setSymmetric(A):
+    """
+    Mark the matrix A as symmetric for the Cholesky (LDL^T) factorization;
+    the flag is kept through the reassemblies of A
     """
-    return A.transpose(PETSc.Mat(MPI.COMM_WORLD))
+    A.setOption(PETSc.Mat.Option.SYMMETRIC, True)
+    A.setOption(PETSc.Mat.Option.SYMMETRY_ETERNAL, True)
 
 from scipy.sparse import csr_matrix
 def convertToCOO(A):
@@ -263,9 +466,15 @@ def computeMatVecProductFwd(A, x):
     y.assemble()
     return y.getArray()
 
+def setBCZero(v, bcs):
+    """
+    Set the entries of the PETSc vector `v` on the Dirichlet dofs to zero
+    """
+    set_bc(v, bcs, scale=0.0)
+
 def applyBC(res, u, bcs):
-    a = form(derivative(res, u))
-    L = form(res)
+    a = cachedForm(derivative(res, u))
+    L = cachedForm(res)
     b = assemble_vector(L)
     apply_lifting(b, [a], [bcs])
     b.ghostUpdate(PETSc.InsertMode.ADD_VALUES, PETSc.ScatterMode.REVERSE)
@@ -300,43 +509,410 @@ def convertToDense(A_petsc):
 def update(v, v_values):
     """
     Update the nodal values in every dof of the DOLFIN function `v`
-    according to `v_values`.
+    according to `v_values`. The copy (with the PETSc assembly and ghost
+    update) is skipped if the values are unchanged; returns True if `v`
+    has been modified.
     -------------------------
     v: dolfin function
     v_values: numpy array
     """
+    v_array = v.vector.getArray(readonly=True)
     if len(v_values) == 1:
+        if np.all(v_array == v_values[0]):
+            return False
         v.vector.set(v_values)
     else:
+        if np.array_equal(v_array, v_values):
+            return False
         setFuncArray(v, v_values)
+    return True
+
+def formDigest(f, dependencies=None):
+    """
+    Compute a digest of the values of the coefficients, constants and mesh
+    geometry that the UFL form `f` depends on, to detect whether an
+    assembled form is still up to date; `dependencies` is the
+    (coefficients, constants) from `formDependencies` to digest instead of
+    all of those in `f`
+    """
+    if dependencies is None:
+        dependencies = (f.coefficients(), f.constants())
+    coefficients, constants = dependencies
+    digest = hashlib.blake2b(digest_size=16)
+    for domain in f.ufl_domains():
+        digest.update(np.ascontiguousarray(domain.ufl_cargo().geometry.x))
+    for coefficient in coefficients:
+        digest.update(np.ascontiguousarray(coefficient.x.array))
+    for constant in constants:
+        digest.update(np.ascontiguousarray(constant.value))
+    return digest.digest()
+
+def formDependencies(f):
+    """
+    Return the coefficients and constants that the UFL form `f` actually
+    depends on after the derivatives are expanded; e.g. the derivative of
+    a residual linear in `f` does not depend on `f` anymore
+    """
+    f_expanded = expand_derivatives(f)
+    return f_expanded.coefficients(), f_expanded.constants()
 
 def computePartials(form, function):
     return derivative(form, function)
 
+def compileForm(f):
+    """
+    Compile the UFL form into a DOLFINx form, which can be assembled
+    repeatedly without calling the form compiler again
+    """
+    return form(f)
+
+def isAffine(res, func):
+    """
+    Check if the residual form `res` is affine in `func`, i.e., if its
+    second derivative wrt `func` vanishes. The test is symbolic, so the
+    piecewise-linear residuals, e.g. with `conditional`, `max_value` or
+    `abs` of `func`, are detected as affine although they are not; pass
+    `linear=False` to `FEA.add_state` for such states.
+    """
+    d2R_du2 = derivative(derivative(res, func), func)
+    return expand_derivatives(d2R_du2).empty()
+
+def nodalDofs(V):
+    """
+    Return the local dof indices of the vector-valued space V, or of a
+    vector subspace such as W.sub(0), in the parent space as an array of
+    shape (number of nodes, block size), with the coordinates of the nodes
+    """
+    if len(V.component()) == 0:
+        bs = V.dofmap.index_map_bs
+        x = V.tabulate_dof_coordinates()
+        dofs = np.arange(x.shape[0]*bs, dtype=np.int32)
+    else:
+        V_collapsed, dofs = V.collapse()
+        bs = V_collapsed.dofmap.index_map_bs
+        x = V_collapsed.tabulate_dof_coordinates()
+    return np.asarray(dofs).reshape(-1, bs), x
+
+def rigidBodyModes(V, displacement=True, rotation=True):
+    """
+    Build the rigid-body modes of the displacement space V as a list of
+    PETSc vectors; V is a vector function space (3 modes in 2D, 6 in 3D),
+    or a mixed space with the displacement in V.sub(0) and the rotations
+    in V.sub(1) such as the shell space `element.W`. The displacement or
+    the rotation parts of the modes are left zero if deselected. Returns
+    None for the other spaces.
+    """
+    if V.num_sub_spaces == 0:
+        return None
+    if V.dofmap.index_map_bs > 1:
+        disp_space, rot_space = V, None
+    elif (V.num_sub_spaces == 2 and V.sub(0).num_sub_spaces == 3
+            and V.sub(1).num_sub_spaces == 3):
+        disp_space, rot_space = V.sub(0), V.sub(1)
+    else:
+        return None
+    u_dofs, x = nodalDofs(disp_space)
+    dim = u_dofs.shape[1]
+    if dim not in (2, 3):
+        return None
+    num_modes = 3 if dim == 2 else 6
+    index_map, bs = V.dofmap.index_map, V.dofmap.index_map_bs
+    modes = [la.create_petsc_vector(index_map, bs) for i in range(num_modes)]
+    with ExitStack() as stack:
+        basis = [np.asarray(stack.enter_context(mode.localForm()))
+                    for mode in modes]
+        for basis_i in basis:
+            basis_i[:] = 0.0
+        if displacement:
+            # Translations
+            for i in range(dim):
+                basis[i][u_dofs[:, i]] = 1.0
+            # Rotations about the z, x and y axes
+            basis[dim][u_dofs[:, 0]] = -x[:, 1]
+            basis[dim][u_dofs[:, 1]] = x[:, 0]
+            if dim == 3:
+                basis[4][u_dofs[:, 1]] = -x[:, 2]
+                basis[4][u_dofs[:, 2]] = x[:, 1]
+                basis[5][u_dofs[:, 0]] = x[:, 2]
+                basis[5][u_dofs[:, 2]] = -x[:, 0]
+        if rotation and rot_space is not None:
+            theta_dofs, _ = nodalDofs(rot_space)
+            basis[3][theta_dofs[:, 2]] = 1.0
+            basis[4][theta_dofs[:, 0]] = 1.0
+            basis[5][theta_dofs[:, 1]] = 1.0
+    return modes
+
+def buildNearNullspace(V):
+    """
+    Build the rigid-body modes of V (see `rigidBodyModes`) as the PETSc
+    near-nullspace for the AMG preconditioners, or None if V has none
+    """
+    modes = rigidBodyModes(V)
+    if modes is None:
+        return None
+    la.orthonormalize(modes)
+    return PETSc.NullSpace().create(vectors=modes)
+
+def createFieldIS(W, W_sub):
+    """
+    Create the PETSc index set of the owned dofs of the subspace W_sub,
+    e.g. W.sub(0), in the global numbering of W
+    """
+    _, dofs = W_sub.collapse()
+    dofs = np.asarray(dofs)
+    index_map, bs = W.dofmap.index_map, W.dofmap.index_map_bs
+    owned_dofs = dofs[dofs < index_map.size_local*bs]
+    global_dofs = (index_map.local_to_global(
+                    (owned_dofs//bs).astype(np.int32))*bs + owned_dofs%bs)
+    return PETSc.IS().createGeneral(
+                    np.sort(global_dofs).astype(PETSc.IntType),
+                    comm=W.mesh.comm)
+
+def createFieldSplit(W, fields):
+    """
+    Create the list of (field name, index set) for the field-split
+    preconditioners from the dictionary `fields` of the subspaces of W,
+    e.g. dict(u=W.sub(0), theta=W.sub(1)). For the mixed shell spaces, the
+    rigid-body modes restricted to the displacement or the rotation block
+    are attached to its index set as the near-nullspace of the block.
+    """
+    field_split = []
+    for field_name, W_sub in fields.items():
+        field_is = createFieldIS(W, W_sub)
+        component = W_sub.component()
+        modes = None
+        if W.dofmap.index_map_bs == 1 and len(component) == 1:
+            modes = rigidBodyModes(W, displacement=(component[0] == 0),
+                                    rotation=(component[0] == 1))
+        if modes is not None:
+            block_modes = []
+            for mode in modes:
+                sub_mode = mode.getSubVector(field_is)
+                if sub_mode.norm() > 0.0:
+                    block_modes.append(sub_mode.copy())
+                mode.restoreSubVector(field_is, sub_mode)
+            la.orthonormalize(block_modes)
+            field_is.compose('nearnullspace',
+                            PETSc.NullSpace().create(vectors=block_modes))
+        field_split.append((field_name, field_is))
+    return field_split
+
+def fieldSplitOptions(field_names, split_type='schur', pc_type='gamg',
+                        ksp_type='gmres', rtol=1e-10):
+    """
+    Return the KSP options of the field-split preconditioner over the
+    fields `field_names`, with the 'schur' or the block Jacobi ('additive')
+    strategy and one V-cycle of `pc_type` on each block
+    """
+    options = dict(ksp_type=ksp_type, pc_type='fieldsplit',
+                    pc_fieldsplit_type=split_type, rtol=rtol)
+    if split_type == 'schur':
+        options['pc_fieldsplit_schur_fact_type'] = 'upper'
+        options['pc_fieldsplit_schur_precondition'] = 'selfp'
+    for field_name in field_names:
+        options['fieldsplit_'+field_name+'_ksp_type'] = 'preonly'
+        options['fieldsplit_'+field_name+'_pc_type'] = pc_type
+    return options
+
 def createFunction(function):
     return Function(function.function_space)
 
-def solveNonlinear(res, func, bc, solver, report, initialize):
+def solveNonlinear(res, func, bc, solver, report, initialize,
+                    nonlinear_solver=None):
+    """
+    Solve the nonlinear problem res(func)=0 with the solver type `solver`;
+    the solver object `nonlinear_solver` from `createNonlinearSolver` is
+    reused if given, otherwise a new one is created for this solve.
+    """
     from timeit import default_timer
     start = default_timer()
-    if solver == 'Newton':
-        newton_solver = NewtonSolver(res, func, bc,
-                                    initialize=initialize,
-                                    report=report)
-        newton_solver.solve(func)
+    if nonlinear_solver is None:
+        nonlinear_solver = createNonlinearSolver(res, func, bc, solver, report)
+    if solver == 'Affine':
+        nonlinear_solver.solve(func)
+    elif solver == 'Newton':
+        # Set the initial guess of the solution
+        if initialize is True:
+            with func.vector.localForm() as func_local:
+                func_local.set(0.1)
+        forcing = getattr(nonlinear_solver, 'forcing', None)
+        if forcing is not None:
+            forcing.reset()
+        nonlinear_solver.solve(func)
     elif solver == 'SNES':
-        snes_solver = SNESSolver(res, func, bc, report=report)
-        snes_solver.solve(None, func.vector)
-        print("Converged reason:", snes_solver.getConvergedReason())
+        nonlinear_solver.solve(None, func.vector)
+        print("Converged reason:", nonlinear_solver.getConvergedReason())
     stop = default_timer()
     if report is True:
         print("Solve nonlinear finished in ",stop-start, "seconds")
+    return nonlinear_solver
+
+def createNonlinearSolver(res, func, bc, solver, report, J=None,
+                            ksp_options=None, options_prefix='',
+                            fields=None, lag_jacobian=1, lag_stagnation=0.5,
+                            eisenstat_walker=False):
+    """
+    Create the Newton, SNES or affine solver for the problem res(func)=0;
+    the solver owns its Jacobian matrix, residual vector and KSP, so it can
+    be reused for repeated solves of the same problem. The linear solver
+    is configured by `ksp_options` (see `configureKSP`) if given. The
+    Jacobian of the SNES solver is lagged by `lag_jacobian` (see
+    `JacobianLag`). With `eisenstat_walker`, the Newton steps of the Newton
+    and SNES solvers are solved inexactly with the Eisenstat-Walker
+    forcing terms as the relative tolerances of their iterative KSPs.
+    """
+    if solver == 'Affine':
+        return AffineSolver(res, func, bc, J=J, ksp_options=ksp_options,
+                            options_prefix=options_prefix, fields=fields)
+    elif solver == 'Newton':
+        return NewtonSolver(res, func, bc, J=J, report=report,
+                            ksp_options=ksp_options,
+                            options_prefix=options_prefix, fields=fields,
+                            eisenstat_walker=eisenstat_walker)
+    elif solver == 'SNES':
+        return SNESSolver(res, func, bc, J=J, report=report,
+                            ksp_options=ksp_options,
+                            options_prefix=options_prefix, fields=fields,
+                            lag_jacobian=lag_jacobian,
+                            lag_stagnation=lag_stagnation,
+                            eisenstat_walker=eisenstat_walker)
+    else:
+        raise ValueError("Unsupported nonlinear solver type: "+str(solver))
+
+
+class AffineSolver:
+    """
+    Solver for the residuals that are affine in the state, where the
+    solution is obtained with one assembly of the linear system and one
+    factorization instead of repeated Newton iterations
+    """
+    def __init__(self, F, w, bcs=[], J=None,
+                    ksp_options=None, options_prefix='', fields=None):
+        self.problem = NonlinearProblem(F, w, bcs, J=J)
+        self.A = create_matrix(self.problem.a)
+        self.b = create_vector(self.problem.L)
+        self.du = self.b.duplicate()
+
+        # setup petsc for pre-only solve with LU w/ MUMPS by default
+        self.ksp = PETSc.KSP().create(w.function_space.mesh.comm)
+        self.ksp.setOperators(self.A)
+        self.ksp.setType("preonly")
+        pc = self.ksp.getPC()
+        pc.setType("lu")
+        pc.setFactorSolverType('mumps')
+        if ksp_options is not None:
+            configureKSP(self.ksp, ksp_options, options_prefix, fields)
+
+    def solve(self, w):
+        """
+        Solve J du = F(w) at the current `w` and update w = w - du,
+        which is exact for the affine residuals
+        """
+        x = w.vector
+        self.problem.form(x)
+        self.problem.F(x, self.b)
+        self.problem.J(x, self.A)
+        self.ksp.solve(self.b, self.du)
+        x.axpy(-1.0, self.du)
+        w.x.scatter_forward()
+
+
+class JacobianLag(object):
+    """
+    The modified Newton strategy of a nonlinear solver: the Jacobian is
+    reassembled, and so refactorized, only every `lag` iterations or when
+    the residual norm is reduced by less than the factor `stagnation` in
+    an iteration. The count persists across the solves, so that the
+    factorization is also reused over the load steps of incremental solves.
+    """
+    def __init__(self, lag=1, stagnation=0.5):
+        self.lag = lag
+        self.stagnation = stagnation
+        self.age = None
+        self.fnorm = None
+        self.assemblies = 0
+
+    def reassemble(self, iteration, fnorm):
+        """
+        Check if the Jacobian is reassembled at the Newton iteration
+        `iteration` of a solve with the current residual norm `fnorm`
+        """
+        stagnated = (iteration > 0 and self.fnorm is not None
+                        and fnorm > self.stagnation*self.fnorm)
+        self.fnorm = fnorm
+        if self.age is None or self.age+1 >= self.lag or stagnated:
+            self.age = 0
+            self.assemblies += 1
+            return True
+        self.age += 1
+        return False
+
+    def reset(self):
+        """
+        Reassemble the Jacobian at the next iteration
+        """
+        self.age = None
+
+
+class EisenstatWalker(object):
+    """
+    The Eisenstat-Walker forcing terms (choice 2) of an inexact Newton
+    method, set as the relative tolerance of the KSP of the Newton steps;
+    the default parameters are the ones of PETSc's SNESKSPSetParametersEW
+    """
+    def __init__(self, ksp, rtol_0=0.3, rtol_max=0.9, gamma=1.0,
+                    alpha=0.5*(1.0+np.sqrt(5.0)), threshold=0.1):
+        self.ksp = ksp
+        self.rtol_0 = rtol_0
+        self.rtol_max = rtol_max
+        self.gamma = gamma
+        self.alpha = alpha
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        """
+        Start the forcing terms of a new nonlinear solve
+        """
+        self.fnorm = None
+        self.rtol = self.rtol_0
+
+    def update(self, fnorm):
+        """
+        Set the tolerance of the next Newton step from the residual norm
+        `fnorm` at the current iterate
+        """
+        if self.fnorm is not None and self.fnorm > 0.0:
+            rtol = self.gamma*(fnorm/self.fnorm)**self.alpha
+            # safeguard against the sudden decrease of the forcing terms
+            rtol_safeguard = self.gamma*self.rtol**self.alpha
+            if rtol_safeguard > self.threshold:
+                rtol = max(rtol, rtol_safeguard)
+            self.rtol = min(rtol, self.rtol_max)
+        self.fnorm = fnorm
+        self.ksp.setTolerances(rtol=self.rtol)
+
+@contextmanager
+def kspTolerances(ksp, rtol=None):
+    """
+    Set the relative tolerance of the KSP to `rtol` within the context,
+    if given, and restore it afterwards
+    """
+    if rtol is None:
+        yield ksp
+        return
+    rtol_0 = ksp.getTolerances()[0]
+    ksp.setTolerances(rtol=rtol)
+    try:
+        yield ksp
+    finally:
+        ksp.setTolerances(rtol=rtol_0)
 
 
 class NonlinearSNESProblem:
 
     def __init__(self, F, u, bcs,
-                 J=None):
+                 J=None, lag=None):
         self.L = form(F)
 
         # Create the Jacobian matrix, dF/du
@@ -348,6 +924,7 @@ class NonlinearSNESProblem:
         self.a = form(J)
         self.bcs = bcs
         self.u = u
+        self.lag = lag
 
     def F(self, snes, x, b):
         # Reset the residual vector
@@ -368,6 +945,11 @@ class NonlinearSNESProblem:
 
     def J(self, snes, x, J, P):
         """Assemble Jacobian matrix."""
+        # With the lagged Jacobian, J is left unchanged, and the KSP reuses
+        # its factorization since the operator state has not changed
+        if (self.lag is not None and not self.lag.reassemble(
+                            snes.getIterationNumber(), snes.getFunctionNorm())):
+            return
         J.zeroEntries()
         assemble_matrix(J, self.a, bcs=self.bcs)
         J.assemble()
@@ -377,13 +959,26 @@ def SNESSolver(F, w, bcs=[],
                     abs_tol=1e-13,
                     rel_tol=1e-13,
                     max_it=100,
-                    report=False):
+                    J=None,
+                    report=False,
+                    ksp_options=None,
+                    options_prefix='',
+                    fields=None,
+                    lag_jacobian=1,
+                    lag_stagnation=0.5,
+                    eisenstat_walker=False):
     """
     https://github.com/FEniCS/dolfinx/blob/main/python/test/unit/nls/test_newton.py#L182-L205
+    With `lag_jacobian` > 1, the Jacobian is lagged as in `JacobianLag`;
+    with `eisenstat_walker`, the KSP tolerances of the Newton steps are the
+    Eisenstat-Walker forcing terms of PETSc (SNESKSPSetUseEW).
     """
     # Create nonlinear problem
 
-    problem = NonlinearSNESProblem(F, w, bcs)
+    lag = None
+    if lag_jacobian > 1:
+        lag = JacobianLag(lag_jacobian, lag_stagnation)
+    problem = NonlinearSNESProblem(F, w, bcs, J=J, lag=lag)
 
     W = w.function_space
     b = la.create_petsc_vector(W.dofmap.index_map, W.dofmap.index_map_bs)
@@ -406,10 +1001,13 @@ def SNESSolver(F, w, bcs=[],
     snes.getKSP().setTolerances(atol=abs_tol,rtol=rel_tol)
     snes.getKSP().getPC().setType("lu")
     snes.getKSP().getPC().setFactorSolverType('mumps')
-
+    if ksp_options is not None:
+        configureKSP(snes.getKSP(), ksp_options, options_prefix, fields)
 
     snes.setFunction(problem.F, b)
     snes.setJacobian(problem.J, J)
+    if eisenstat_walker is True:
+        snes.setUseEW(True)
 
     snes.setFromOptions()
 
@@ -422,18 +1020,36 @@ def NewtonSolver(F, w, bcs=[],
                     max_it=3,
                     initialize=False,
                     error_on_nonconvergence=False,
-                    report=False):
+                    J=None,
+                    report=False,
+                    ksp_options=None,
+                    options_prefix='',
+                    fields=None,
+                    eisenstat_walker=False):
 
     """
     Wrap up the nonlinear solver for the problem F(w)=0 and
-    returns the solution
+    returns the solution. With `eisenstat_walker`, the KSP tolerance of
+    each Newton step is set from the residual norms by `EisenstatWalker`.
     """
-    problem = NonlinearProblem(F, w, bcs)
+    problem = NonlinearProblem(F, w, bcs, J=J)
+    forcing = None
+    if eisenstat_walker is True:
+        # The residual is evaluated once per iterate, before the Jacobian
+        # and the linear solve of the next Newton step
+        F_problem = problem.F
+        def F_forcing(x, b):
+            F_problem(x, b)
+            forcing.update(b.norm())
+        problem.F = F_forcing
     # Set the initial guess of the solution
     if initialize is True:
         with w.vector.localForm() as w_local:
             w_local.set(0.1)
     solver = PETScNewtonSolver(MPI.COMM_WORLD, problem)
+    # The Jacobian matrix is private (`_A`) in the dolfinx Newton solver;
+    # expose it like the `A` of the affine solver (see `getSolverMatrix`)
+    solver.A = solver._A
     if report is True:
         dolfinx.log.set_log_level(dolfinx.log.LogLevel.INFO)
 
@@ -445,9 +1061,129 @@ def NewtonSolver(F, w, bcs=[],
     solver.error_on_nonconvergence = error_on_nonconvergence
     opts = PETSc.Options()
     opts["nls_solve_pc_factor_mat_solver_type"] = "mumps"
+    if ksp_options is not None:
+        configureKSP(solver.krylov_solver, ksp_options, options_prefix,
+                        fields)
+    if eisenstat_walker is True:
+        forcing = EisenstatWalker(solver.krylov_solver)
+        solver.forcing = forcing
 
     return solver
 
+def getSolverMatrix(nonlinear_solver, solver):
+    """
+    Return the Jacobian matrix owned by the solver from
+    `createNonlinearSolver` of the type `solver`
+    """
+    if solver == 'SNES':
+        return nonlinear_solver.getJacobian()[0]
+    return nonlinear_solver.A
+
+def getSolverKSP(nonlinear_solver, solver):
+    """
+    Return the KSP of the linear solves of the solver from
+    `createNonlinearSolver` of the type `solver`
+    """
+    if solver == 'SNES':
+        return nonlinear_solver.getKSP()
+    elif solver == 'Newton':
+        return nonlinear_solver.krylov_solver
+    return nonlinear_solver.ksp
+
+def mumpsOptions(blr_tol=None, out_of_core=False,
+                    mem_relax=None, num_threads=None):
+    """
+    Return the KSP options of the MUMPS controls for the LU factorizations:
+    the block-low-rank compression with the dropping tolerance `blr_tol`
+    (ICNTL(35), CNTL(7)), the out-of-core factors (ICNTL(22)), the
+    percentage of the memory relaxation `mem_relax` (ICNTL(14)) and the
+    number of OpenMP threads (ICNTL(16)). The directory of the out-of-core
+    factors is set for the whole process by `setMumpsOutOfCoreDir`.
+    """
+    options = dict()
+    if blr_tol is not None:
+        options['mat_mumps_icntl_35'] = 1
+        options['mat_mumps_cntl_7'] = blr_tol
+    if out_of_core:
+        options['mat_mumps_icntl_22'] = 1
+    if mem_relax is not None:
+        options['mat_mumps_icntl_14'] = mem_relax
+    if num_threads is not None:
+        options['mat_mumps_icntl_16'] = num_threads
+    return options
+
+def selectMumpsOptions(options):
+    """
+    Return the MUMPS controls from the KSP options `options`
+    """
+    if options is None:
+        return dict()
+    return dict((key, value) for key, value in options.items()
+                    if key.startswith('mat_mumps_'))
+
+def setMumpsOutOfCoreDir(path):
+    """
+    Set the directory of the out-of-core MUMPS factors; MUMPS reads it from
+    the environment variable MUMPS_OOC_TMPDIR, so it applies to all the
+    factorizations in the process, not to a single state or FEA
+    """
+    os.environ['MUMPS_OOC_TMPDIR'] = path
+
+options_prefixes = itertools.count()
+
+def uniquePrefix(name):
+    """
+    Return a PETSc options prefix starting with `name` that is unique in
+    the process, so that the options of the KSPs configured for different
+    FEA instances are kept apart in the global options database
+    """
+    return '{}{}_'.format(name, next(options_prefixes))
+
+def configureKSP(ksp, options, prefix='', fields=None):
+    """
+    Set the KSP type, preconditioner and tolerances from the dictionary
+    `options` through the PETSc options database under `prefix`. The keys
+    'rtol', 'atol' and 'max_it' are short for the 'ksp_' options; other
+    keys are PETSc option names, e.g. 'ksp_type', 'pc_type' or
+    'pc_hypre_type' or the MUMPS controls from `mumpsOptions`, and None
+    sets a flag option. `fields` is the list of
+    (field name, index set) from `createFieldSplit` for the 'fieldsplit'
+    preconditioner.
+    """
+    opts = PETSc.Options()
+    for key, value in options.items():
+        if key in ('rtol', 'atol', 'max_it'):
+            key = 'ksp_'+key
+        opts[prefix+key] = value
+    ksp.setOptionsPrefix(prefix)
+    if fields is not None and options.get('pc_type') == 'fieldsplit':
+        pc = ksp.getPC()
+        pc.setType('fieldsplit')
+        pc.setFieldSplitIS(*fields)
+    ksp.setFromOptions()
+    return ksp
+
+def createKSP(A, options, prefix='', fields=None):
+    """
+    Create the KSP for the linear system with the operator A, configured
+    by `options` (see `configureKSP`)
+    """
+    ksp = PETSc.KSP().create(A.getComm())
+    ksp.setOperators(A)
+    configureKSP(ksp, options, prefix, fields)
+    return ksp
+
+def supportsTransposeSolve(options):
+    """
+    Check if the preconditioner of the KSP options can be applied in
+    transpose; BoomerAMG from hypre and the Schur complement field split
+    can not
+    """
+    if (options.get('pc_type') == 'fieldsplit'
+            and options.get('pc_fieldsplit_type') == 'schur'):
+        return False
+    return options.get('pc_type') not in ('hypre',)
+
 def solveKSP(A, b, x):
     """
     Wrap up the KSP solver for the linear system Ax=b
@@ -473,28 +1209,29 @@ def solveKSP(A, b, x):
     ksp.solve(b, x)
     history = ksp.getConvergenceHistory()
 
-def solveKSP_mumps(A, b, x):
+def solveKSP_mumps(A, b, x, transpose=False, options=None, prefix=''):
     """
-    Implementation of KSP solution of the linear system Ax=b using MUMPS
+    Implementation of KSP solution of the linear system Ax=b using MUMPS;
+    with `transpose=True`, A^T x=b is solved with the same factorization.
+    The factorization is not kept; the repeated solves with the same A
+    should keep the KSP from `setUpKSP_MUMPS` instead.
     """
+    ksp = setUpKSP_MUMPS(A, options, prefix)
+    if transpose:
+        ksp.solveTranspose(b, x)
+    else:
+        ksp.solve(b, x)
+    ksp.destroy()
 
-    # setup petsc for pre-only solve
-    ksp = PETSc.KSP().create(A.getComm())
-    ksp.setOperators(A)
-    ksp.setType("preonly")
-
-    # set LU w/ MUMPS
-    pc = ksp.getPC()
-    pc.setType("lu")
-    pc.setFactorSolverType('mumps')
-
-    # solve
-    ksp.setUp()
-    ksp.solve(b, x)
-
-def setUpKSP_MUMPS(A):
+def setUpKSP_MUMPS(A, options=None, prefix='', symmetric=False):
     """
-    Implementation of KSP solution of the linear system Ax=b using MUMPS
+    Implementation of KSP solution of the linear system Ax=b using MUMPS.
+    The caller owns the KSP: as long as it is kept with A, the ordering and
+    the symbolic factorization are computed once, and PETSc only redoes
+    the numeric factorization when the values of A change with the same
+    nonzero pattern. The MUMPS controls in `options` (see `mumpsOptions`)
+    are set under `prefix`. A `symmetric` matrix is factorized with LDL^T
+    (Cholesky) instead of LU.
     """
 
     # setup petsc for pre-only solve
@@ -502,12 +1239,19 @@ def setUpKSP_MUMPS(A):
     ksp.setOperators(A)
     ksp.setType("preonly")
 
-    # set LU w/ MUMPS
+    # set LU (or LDL^T) w/ MUMPS
     pc = ksp.getPC()
-    pc.setType("lu")
+    if symmetric:
+        setSymmetric(A)
+        pc.setType("cholesky")
+    else:
+        pc.setType("lu")
     pc.setFactorSolverType('mumps')
+    mumps_options = selectMumpsOptions(options)
+    if len(mumps_options) > 0:
+        configureKSP(ksp, mumps_options, prefix)
 
-    # solve
+    # factorize
     ksp.setUp()
     return ksp
 
@@ -546,7 +1290,8 @@ def createCustomMeasure(mesh, dim, SubdomainFunc, measure: str, tag: int):
     return custom_measure
 
 
-def project(v, target_func, bcs=[], lump_mass=False):
+def project(v, target_func, bcs=[], lump_mass=False, interpolate=False,
+            solver_options=None):
 
     """
     L2 projection of an UFL object (expression) to targeted function.
@@ -554,33 +1299,142 @@ def project(v, target_func, bcs=[], lump_mass=False):
     `lump_mass` is an optional boolean argument set to be False by default;
     it's set to be True when lumping is needed for preventing oscillation
     when projecting discontinous data.
+    The mass matrix (or its lumped diagonal) is assembled and factorized
+    once per target function space. With `interpolate`, the expression is
+    evaluated at the interpolation points of the target space instead,
+    which is exact for the DG/quadrature targets without a linear solve.
+    The MUMPS controls in `solver_options` apply to the factorization.
     """
-
-    # Ensure we have a mesh and attach to measure
+    if interpolate:
+        interpolateExpression(v, target_func)
+        return
     V = target_func.function_space
+    L = inner(v, TestFunction(V)) * dx
+    operator = getProjectionOperator(V, bcs, lump_mass, solver_options)
+    operator.solve(cachedForm(L), target_func)
+
+def projectionForms(v, V, lump_mass=False):
+    """
+    The bilinear (or lumped linear) and linear forms of the L2 projection
+    of an UFL expression `v` to the function space `V`
+    """
     # Define variational problem for projection
     w = TestFunction(V)
-    Pv = TrialFunction(V)
-
     L = inner(v, w) * dx
+    return projectionMassForm(V, lump_mass), L
+
+def projectionMassForm(V, lump_mass=False):
+    """
+    The mass form (or the lumped mass linear form) of the L2 projection to
+    the function space `V`
+    """
+    w = TestFunction(V)
+    Pv = TrialFunction(V)
     if(lump_mass):
-        a = inner(Constant(V.mesh, 1.0),w)*dx
-        A = assemble_vector(form(a))
-        b = assemble_vector(form(L))
-        target_func.vector.pointwiseDivide(b,A)
+        a = inner(1.0,w)*dx
     else:
         a = inner(Pv,w)*dx #lhs(res)
-        # a = inner(Pv, w) * dx
-        # Assemble linear system
-        A = assemble_matrix(form(a), bcs)
-        A.assemble()
-        b = assemble_vector(form(L))
-        apply_lifting(b, [form(a)], [bcs])
-        b.ghostUpdate(addv=PETSc.InsertMode.ADD, mode=PETSc.ScatterMode.REVERSE)
-        set_bc(b, bcs)
-        solver = PETSc.KSP().create(A.getComm())
-        solver.setOperators(A)
-        solver.solve(b, target_func.vector)
+    return a
+
+class ProjectionOperator(object):
+    """
+    The mass matrix of the L2 projection to the function space V with its
+    factorized KSP, or the lumped mass vector; they are reassembled only if
+    the mesh geometry has changed (see `update`)
+    """
+    def __init__(self, V, bcs=[], lump_mass=False, solver_options=None):
+        self.V = V
+        self.bcs = bcs
+        self.lump_mass = lump_mass
+        self.mass_form = projectionMassForm(V, lump_mass)
+        self.a = form(self.mass_form)
+        self.digest = formDigest(self.mass_form)
+        self.ksp = None
+        if lump_mass:
+            self.M = assemble_vector(self.a)
+            self.M.ghostUpdate(addv=PETSc.InsertMode.ADD,
+                                mode=PETSc.ScatterMode.REVERSE)
+        else:
+            self.M = assemble_matrix(self.a, bcs)
+            self.M.assemble()
+            # The mass matrix is symmetric, also with the strong BCs
+            self.ksp = setUpKSP_MUMPS(self.M, solver_options,
+                                        prefix=uniquePrefix('projection'),
+                                        symmetric=True)
+
+    def solve(self, L, target_func):
+        """
+        Project with the compiled linear form `L` to `target_func`
+        """
+        b = assemble_vector(L)
+        if not self.lump_mass:
+            apply_lifting(b, [self.a], [self.bcs])
+        b.ghostUpdate(addv=PETSc.InsertMode.ADD,
+                        mode=PETSc.ScatterMode.REVERSE)
+        if not self.lump_mass:
+            set_bc(b, self.bcs)
+        self.applyInverse(b, target_func.vector)
+        target_func.x.scatter_forward()
+        b.destroy()
+
+    def update(self):
+        """
+        Reassemble the mass matrix (or vector) in place if the mesh geometry
+        has changed since its last assembly; the KSP then refactors it
+        numerically at the next solve
+        """
+        digest = formDigest(self.mass_form)
+        if digest == self.digest:
+            return
+        self.digest = digest
+        if self.lump_mass:
+            with self.M.localForm() as M_local:
+                M_local.set(0.0)
+            assemble_vector(self.M, self.a)
+            self.M.ghostUpdate(addv=PETSc.InsertMode.ADD,
+                                mode=PETSc.ScatterMode.REVERSE)
+        else:
+            self.M.zeroEntries()
+            assemble_matrix(self.M, self.a, self.bcs)
+            self.M.assemble()
+
+    def applyInverse(self, b, x):
+        """
+        Solve M x = b with the factorized (or lumped) mass matrix M
+        """
+        if self.lump_mass:
+            x.pointwiseDivide(b, self.M)
+        else:
+            self.ksp.solve(b, x)
+
+projection_operators = ObjectCache(maxsize=16)
+
+def getProjectionOperator(V, bcs=[], lump_mass=False, solver_options=None):
+    """
+    Return the projection operator of the function space V from a bounded
+    LRU cache, updated to the current mesh geometry
+    """
+    mumps_options = selectMumpsOptions(solver_options)
+    key = (id(V), tuple(id(bc) for bc in bcs), lump_mass,
+            tuple(sorted(mumps_options.items())))
+    operator = projection_operators.lookup(key)
+    if operator is None:
+        operator = projection_operators.insert(key, (V, bcs),
+                        ProjectionOperator(V, bcs, lump_mass, mumps_options))
+    else:
+        operator.update()
+    return operator
+
+compiled_expressions = ExpressionCache(maxsize=128)
+
+def interpolateExpression(v, target_func):
+    """
+    Interpolate the UFL expression `v` to `target_func` by evaluating it
+    at the interpolation points of the target element with a compiled
+    `dolfinx.fem.Expression`, which is kept for the repeated calls
+    """
+    expression = compiled_expressions.get(v, target_func.function_space)
+    target_func.interpolate(expression)
 
 
 